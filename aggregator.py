@@ -1,15 +1,24 @@
 import pandas as pd
 import numpy as np
 import time
-import pickle
+import os
+import threading
 
 from systemData import routeData, stationLoc
 from visualize import file_timestamp
 
 from stations import station_names
+from columnStore import read_stop_table, write_stop_table
+from statStore import statArchive, write_store, DESCRIBE_STATS, SCALAR_STATS, STORE_EXT
+from sketches import streamingStats, mergeableStats
 
 TIME_RESOLUTION_FACTOR = 1e9
 
+## range queries: partial aggregates are kept per service date and per slot of this many minutes
+PARTIAL_SLOT_MINUTES = 15
+WEEKDAYS = [0, 1, 2, 3, 4]
+WEEKEND = [5, 6]
+
 # handle a sequence of stoptime.csv files that are concatenated together
 def concat(ll,dd):
     with open("stoptimes/manifest." + ll + "_" + dd + ".txt",'r') as f:
@@ -18,10 +27,11 @@ def concat(ll,dd):
     for filename in manifest:
         if filename!="":
             print "importing>>",filename,"<<"
-            df = pd.read_csv("stoptimes/"+filename, index_col=0)
+            df = read_stop_table("stoptimes/" + os.path.splitext(filename)[0])
             DFs.append(df)
     DFconcat = pd.concat(DFs)
     DFconcat.to_csv("stoptimes/master." + ll + "_" + dd + ".concat.csv")
+    write_stop_table(DFconcat, "stoptimes/master." + ll + "_" + dd + ".concat")
     return DFconcat
 
 def preprocess(fname):
@@ -62,6 +72,45 @@ def _make_timestamp(timestring):
     dt = pd.to_datetime(timestring)
     return dt.value/TIME_RESOLUTION_FACTOR
 
+## stand-in for a per-hour stats dict that is fetched from its aggregator on first access
+class lazySeries():
+        def __init__(self, agg, token):
+                self.agg = agg
+                self.token = token
+                self._series = None
+
+        def resolve(self):
+                if self._series is None:
+                        with self.agg._lock:
+                                if self._series is None:
+                                        try:
+                                                series = self.agg.fetchSeries(self.token)
+                                        except IOError as e:
+                                                series = self.agg.fetchFailed(self.token, e)
+                                        self._series = series or self.agg.nullSeries(self.token)
+                return self._series
+
+        def get(self, hour, default=None):
+                return self.resolve().get(hour, default)
+
+        def __getitem__(self, hour):
+                return self.resolve()[hour]
+
+        def keys(self):
+                return self.resolve().keys()
+
+def precompute(series, name="aggregator-precompute"):
+        """Resolve lazySeries objects on a daemon thread, so the first render does not pay for them."""
+        def _resolve_all():
+                t0 = time.time()
+                for s in series:
+                        s.resolve()
+                print "precomputed",len(series),"series in %.1f secs" % (time.time() - t0)
+        worker = threading.Thread(target=_resolve_all, name=name)
+        worker.daemon = True
+        worker.start()
+        return worker
+
 ## base class
 ## derived classes are expected to implement CalcInterval
 class aggregator():
@@ -71,17 +120,22 @@ class aggregator():
                 self.useComputed = useComputed
                 self.firstCalc = True
                 self.calcCounter = 0
+                self.online = False
+                self._lock = threading.RLock()
+                self.partials = None
+                self.fetchError = None
                 if not self.useComputed:
                         print "useComputed flag is set to false.\nThis forces re-calculation of interval data and is a time-consuming call.\nThis call should only be made occasionally when re-computes are required. Otherwise re-use archived data if possible by setting useCompute=True."
 
         def calcInit(self):
                 ## needs to be more robust access to database
                 #fname_string = "data/subway_data_" + file_timestamp + "_" + self.line + "_" + self.direction + "_stoptimes.csv"
-                fname_string = "stoptimes/master." + self.line + "_" + self.direction + ".concat.csv"
-                self.df = pd.read_csv(fname_string, index_col=0, error_bad_lines=False, warn_bad_lines=True)
+                fname_root = "stoptimes/master." + self.line + "_" + self.direction + ".concat"
+                self.df = read_stop_table(fname_root, error_bad_lines=False, warn_bad_lines=True)
                 print "DF len",len(self.df)
                 print "droping label rows",len(self.df[self.df.index=="id"])
-                self.df = self.df.drop(["id"])
+                if "id" in self.df.index:
+                        self.df = self.df.drop(["id"])
                 #badI = self.df[self.df.index==np.nan].index
                 #print "bad index",len(badI)
                 self._data_tmax = self.df.max().max() 
@@ -94,61 +148,216 @@ class aggregator():
                 print self.df.columns
 
         def loadData(self):
+                ## compact archive first; a legacy pickled archive is only read, never converted here
+                ## (statStore.migrate_archives() does that, explicitly, for every archive at once)
+                self.computedSeries = None
                 try:
-                        with open(self.db_filename,'r') as f:
-                                self.computedSeries = pickle.load(f)
+                        if not os.path.exists(self.store_filename) and os.path.exists(self.db_filename):
+                                self.computedSeries = pd.read_pickle(self.db_filename)
+                                print self.ID, "Loaded legacy archive with",len(self.computedSeries.keys()),"records; run statStore.migrate_archives() to convert it"
+                        else:
+                                self.computedSeries = statArchive(self.store_filename, null_value=self.archiveNull)
                                 print self.ID, "Loaded archive with",len(self.computedSeries.keys()),"records"
-                except:
-                        self.computedSeries = {}
-                        print self.ID, "failed to load data. starting with empty dict"
+                except Exception as e:
+                        self.computedSeries = statArchive(stats=self.archiveStats, null_value=self.archiveNull)
+                        print self.ID, "failed to load data. starting with empty dict",e
 
         def storeData(self):
-                if self.firstCalc:
+                if self.firstCalc and not self.online:
                         print self.ID,"storeData called but no new data computed; nothing to store"
                 else:
-                        with open(self.db_filename,'w') as f:
-                                pickle.dump(self.computedSeries, f)
+                        write_store(self.store_filename, self.computedSeries, self.archiveStats)
                         print self.ID,"wrote",len(self.computedSeries),"computed station records to archive"
 
         def calcSeries(self, token):
-                if self.firstCalc:
-                        self.calcInit()
-                        self.firstCalc = False
-                stats_per_hour = {}
-                for hmin in range(0,24):
-                        hmax = hmin+1
-                        stats_per_hour[hmin] = self.calcInterval(hmin, hmax, token)
-                self.computedSeries[token] = stats_per_hour 
-                self.calcCounter = self.calcCounter + 1
-                if self.calcCounter % 20 == 0:
-                        self.storeData()
-                return stats_per_hour
+                with self._lock:
+                        if self.firstCalc:
+                                self.calcInit()
+                                self.firstCalc = False
+                        stats_per_hour = {}
+                        for hmin in range(0,24):
+                                hmax = hmin+1
+                                stats_per_hour[hmin] = self.calcInterval(hmin, hmax, token)
+                        self.computedSeries[token] = stats_per_hour 
+                        self.calcCounter = self.calcCounter + 1
+                        if self.calcCounter % 20 == 0:
+                                self.storeData()
+                        return stats_per_hour
+
+        def _hourBucket(self):
+                """Hour bucket of each row as calcInterval selects rows (hmin < time < hmin+1), or -1 for none."""
+                time_of_day = self.df["time"].values
+                hour = np.floor(time_of_day).astype(int)
+                return np.where((time_of_day > hour) & (hour >= 0) & (hour < 24), hour, -1)
 
         def fetchSeries(self, token):
                 if self.useComputed and self.computedSeries.get(token):
                         return self.computedSeries[token]
                 else:
+                        if self.fetchError is not None:
+                                return self.nullSeries(token)
                         if self.useComputed:
                                 print self.ID, "did not find records for",token
                         else:
                                 print self.ID, "forcing compute for",token
                         return self.calcSeries(token)
 
+        def nullSeries(self, token):
+                ## the defaults are stored under token, so observe() updates the dict routes already hold
+                with self._lock:
+                        series = self.computedSeries.get(token)
+                        if series is None:
+                                series = dict([(h, self.liveDefault) for h in range(24)])
+                                self.computedSeries[token] = series
+                        return series
+
+        def fetchFailed(self, token, e):
+                ## stoptimes missing or unreadable: report once, then answer every later token with defaults
+                if self.fetchError is None:
+                        print self.ID, "cannot compute series, using defaults from now on:", e
+                        self.fetchError = e
+                return self.nullSeries(token)
+
+        def buildPartials(self, tokens=None, slotMinutes=PARTIAL_SLOT_MINUTES):
+                """Summarize the stoptimes table once into mergeable per-(date, time slot) partials.
+
+                Each token gets a mergeableStats whose cells are date_code*slots_per_day + slot, with
+                the slot taken from the trip start time. Rows are kept as calcInterval keeps them, so a
+                trip starting exactly on the hour is in no slot (hmin < time < hmin+1; see
+                _hourBucket), while one starting on any other slot boundary is. query() answers every
+                later selection of days and bucket width by merging these cells.
+                tokens defaults to those already in computedSeries. Partials are added to those already
+                built at the same slotMinutes; a different slotMinutes starts again from none.
+                """
+                with self._lock:
+                        if self.firstCalc:
+                                self.calcInit()
+                                self.firstCalc = False
+                        if tokens is None:
+                                tokens = self.computedSeries.keys()
+                        if self.partials is None or slotMinutes != self.partialSlotMinutes:
+                                ## per-row slot and date codes are shared by every token; computed once per width
+                                self.partialSlotMinutes = slotMinutes
+                                self.partialSlots = 24*60/slotMinutes
+                                slot = np.floor(self.df["time"].values*60./slotMinutes).astype(int)
+                                slot[(slot < 0) | (slot >= self.partialSlots) | (self._hourBucket() < 0)] = -1
+                                date_codes, dates = pd.factorize(self.df["date"].values)
+                                self.partialDates = np.array([float(d) for d in dates])
+                                self._partialRows = (date_codes, slot)
+                                self.partials = {}
+                        date_codes, slot = self._partialRows
+                        for token in tokens:
+                                row_i, values = self.partialObservations(token, date_codes, slot)
+                                self.partials[token] = mergeableStats(date_codes[row_i]*self.partialSlots + slot[row_i], values)
+                        print self.ID,"built partial aggregates for",len(tokens),"tokens over",len(self.partialDates),"dates"
+                        return self.partials
+
+        def query(self, token, dates=None, start=None, end=None, weekdays=None, bucketMinutes=60):
+                """Statistics for token over a selection of days, bucketed by time of day.
+
+                dates lists service dates (the midnight timestamps that end each long_id); start and
+                end bound the dates inclusively; weekdays keeps days of the week (0 is Monday, see
+                WEEKDAYS and WEEKEND). bucketMinutes must be a multiple of the partial slot width.
+                Returns {bucket: describe() Series}, bucket b covering b*bucketMinutes minutes after
+                midnight onwards (the last bucket ends at midnight, so it may be shorter), in the
+                units calcInterval reports. Nothing is rescanned: the
+                answer merges the partials built by buildPartials.
+                """
+                if self.partials is None:
+                        self.buildPartials()
+                if token not in self.partials:
+                        self.buildPartials([token], self.partialSlotMinutes)
+                if bucketMinutes % self.partialSlotMinutes != 0:
+                        raise ValueError("bucketMinutes must be a multiple of " + str(self.partialSlotMinutes))
+                use_date = np.ones(len(self.partialDates), dtype=bool)
+                if dates is not None:
+                        use_date &= np.in1d(self.partialDates, [float(d) for d in dates])
+                if start is not None:
+                        use_date &= self.partialDates >= start
+                if end is not None:
+                        use_date &= self.partialDates <= end
+                if weekdays is not None:
+                        use_date &= np.array([time.localtime(d)[6] in weekdays for d in self.partialDates], dtype=bool)
+                partial = self.partials[token]
+                date_code = partial.cells // self.partialSlots
+                bucket = (partial.cells % self.partialSlots) // (bucketMinutes / self.partialSlotMinutes)
+                merged = partial.merge(use_date[date_code], bucket)
+                stats_per_bucket = {}
+                ## ceiling division: a width that does not divide the day leaves a shorter last bucket
+                for b in range(-(-24*60 // bucketMinutes)):
+                        stats = pd.Series([0.] + [np.nan]*7, index=DESCRIBE_STATS)
+                        if b in merged.cells:
+                                stats = merged.describe(np.searchsorted(merged.cells, b))
+                                stats[DESCRIBE_STATS[1:]] = stats[DESCRIBE_STATS[1:]]*self.queryScale
+                        stats_per_bucket[b] = stats
+                return stats_per_bucket
+
+        def fetchLazy(self, token):
+                ## defer archive decoding, and any calcInit, until the series is first read
+                return lazySeries(self, token)
+
+        def enableOnline(self, minCount=10):
+                """Let live observations refresh the stored statistics.
+
+                Each (token, hour) gets a streamingStats sketch fed by observe(). Once a sketch has
+                seen minCount values its summary replaces that hour in computedSeries. The per-hour
+                dict is updated in place, so routes and stops that already hold it through fetchSeries
+                pick up the new value without being rebuilt.
+                """
+                self.online = True
+                self.onlineMinCount = minCount
+                self.liveStats = {}
+                print self.ID,"online updates enabled after",minCount,"observations per hour"
+
+        def observe(self, token, hour, value):
+                ## O(1) per event; memory is one fixed-size sketch per token and hour
+                if not self.online:
+                        return
+                per_hour = self.liveStats.setdefault(token, {})
+                if hour not in per_hour:
+                        per_hour[hour] = streamingStats()
+                sketch = per_hour[hour]
+                sketch.add(value)
+                if sketch.count < self.onlineMinCount:
+                        return
+                self.nullSeries(token)[hour] = self.liveValue(sketch)
+
 # average time between two stations
 class segmentAggregator(aggregator):
+        archiveStats = DESCRIBE_STATS
+        ## per-hour placeholders: one hour's entry of NULL_STATS, read as stats.get(hour).get('50%')
+        archiveNull = NULL_STATS[0]
+        liveDefault = NULL_STATS[0]
+        queryScale = 1.
+
         def __init__(self, ll, dd, useComputed=True):
                 aggregator.__init__(self, ll, dd, useComputed)
                 self.ID = "segmentAggregatorArchive_" + self.line + "_" + self.direction
                 self.db_filename = "data/." + self.ID + ".dict"
+                self.store_filename = "data/." + self.ID + STORE_EXT
                 self.loadData()
 
+        def liveValue(self, sketch):
+                # travel times in seconds, as calcInterval's describe()
+                return sketch.describe()
+
+        def partialObservations(self, token, date_codes, slot):
+                ## rows and travel times (secs) feeding buildPartials; negatives dropped as in calcInterval
+                origin, dest = token
+                if origin not in self.df.columns or dest not in self.df.columns:
+                        return np.array([], dtype=int), np.array([])
+                diff = self.df[dest].values.astype(float) - self.df[origin].values.astype(float)
+                with np.errstate(invalid='ignore'):
+                        row_i = np.nonzero((slot >= 0) & (diff >= 0))[0]
+                return row_i, diff[row_i]
+
         def calcInterval(self, hmin, hmax, (origin, dest)):
                 df_select = self.df[self.df["time"]>hmin]
                 df_select = df_select[df_select["time"]<hmax]
 	        if origin not in df_select.columns:
-	                return NULL_STATS
+	                return NULL_STATS[hmin]
 	        if dest not in df_select.columns:
-	                return NULL_STATS
+	                return NULL_STATS[hmin]
                 diff = df_select[dest] - df_select[origin]
                 # just drop negatives but should do something more sophisticated
                 todrop = diff[diff<0].index
@@ -160,14 +369,80 @@ class segmentAggregator(aggregator):
                 stats = diff_secs.describe()
                 return stats
 
+        def computeAll(self, tokens=None):
+                """Compute every segment's per-hour stats in one pass and store them.
+
+                Equivalent to calcSeries for each token, but the stoptimes table is reshaped
+                once into (segment, hour, travel time) records and summarized by a single groupby
+                rather than rescanned for each of the 24 hours of every segment.
+                tokens defaults to the consecutive-stop segments of this line and direction.
+                """
+                if self.firstCalc:
+                        self.calcInit()
+                        self.firstCalc = False
+                if tokens is None:
+                        routes = routeData().get(self.line, self.direction)
+                        tokens = zip(routes['origin'].values, routes['destination'].values)
+                hour = self._hourBucket()
+                in_hours = hour >= 0
+                segments = []
+                records = []
+                for origin, dest in tokens:
+                        if origin not in self.df.columns or dest not in self.df.columns:
+                                self.computedSeries[(origin, dest)] = dict([(h, NULL_STATS[h]) for h in range(24)])
+                                continue
+                        diff = self.df[dest].values.astype(float) - self.df[origin].values.astype(float)
+                        # as calcInterval: negatives and missing stops are dropped
+                        keep = in_hours & (diff >= 0)
+                        records.append(pd.DataFrame({'segment':len(segments), 'hour':hour[keep], 'diff':diff[keep]}))
+                        segments.append((origin, dest))
+                if len(segments) > 0:
+                        described = pd.concat(records).groupby(['segment','hour'])['diff'].describe()
+                        stats = np.empty((len(segments), 24, len(self.archiveStats)))
+                        stats.fill(np.nan)
+                        stats[:, :, 0] = 0.
+                        seg_i = described.index.get_level_values(0).values
+                        hour_i = described.index.get_level_values(1).values
+                        stats[seg_i, hour_i, :] = described[self.archiveStats].values
+                        for i, token in enumerate(segments):
+                                self.computedSeries[token] = dict([(h, pd.Series(stats[i, h, :], index=self.archiveStats)) for h in range(24)])
+                print self.ID,"computed",len(segments),"segments in bulk"
+                self.storeData()
+                return self.computedSeries
+
 # frequency of trains at a given stop
 class frequencyAggregator(aggregator):
+        archiveStats = SCALAR_STATS
+        archiveNull = None
+        liveDefault = 0.
+        queryScale = 1/60.
+
         def __init__(self, ll, dd, useComputed=True):
                 aggregator.__init__(self, ll, dd, useComputed)
                 self.ID = "intervalAggregatorArchive_" + self.line + "_" + self.direction
                 self.db_filename = "data/." + self.ID + ".dict"
+                self.store_filename = "data/." + self.ID + STORE_EXT
                 self.loadData()
 
+        def partialObservations(self, station, date_codes, slot):
+                ## headways (secs) between consecutive arrivals on the same date, filed under the later
+                ## train's slot; unlike calcInterval a headway may span a bucket boundary, which keeps
+                ## the partials independent of the bucket width queried later
+                if station not in self.df.columns:
+                        return np.array([], dtype=int), np.array([])
+                ticks = self.df[station].values.astype(float)
+                row_i = np.nonzero(~np.isnan(ticks))[0]
+                row_i = row_i[np.lexsort((ticks[row_i], date_codes[row_i]))]
+                same_date = date_codes[row_i][1:] == date_codes[row_i][:-1]
+                headways = (ticks[row_i][1:] - ticks[row_i][:-1])[same_date]
+                later = row_i[1:][same_date]
+                keep = slot[later] >= 0
+                return later[keep], headways[keep]
+
+        def liveValue(self, sketch):
+                # observations are in seconds; the archive holds minutes
+                return sketch.mean/60.
+
         def calcInterval(self, hmin, hmax, station):
                 df_select = self.df[self.df["time"]>hmin]
                 df_select = df_select[df_select["time"]<hmax]
@@ -179,7 +454,7 @@ class frequencyAggregator(aggregator):
                 for d in self.dates:
                         df_sub = df_station[df_station["date"]==d]
                         ticks = df_sub[station].dropna().astype(int).values
-                        ticks.sort
+                        ticks.sort()
                         intervals = ticks[1:] - ticks[:-1]
                         all_intervals = np.hstack((all_intervals, intervals))
                 station_mean = all_intervals.mean()/60.
@@ -187,12 +462,68 @@ class frequencyAggregator(aggregator):
                         return 0.
                 return station_mean
 
+        def computeAll(self, stations=None):
+                """Compute headways for every station and hour in one vectorized pass.
+
+                The stoptimes table is melted once into (station, hour, date, time) records and
+                sorted, so each headway is the difference between consecutive arrivals that share
+                station, hour and date. Per-hour means (in minutes, 0. where there is no data)
+                populate computedSeries exactly as calcSeries would; the full describe() of the
+                headways, percentiles included, is kept in self.headwayStats[station][hour].
+                stations defaults to every station of this line and direction.
+                """
+                if self.firstCalc:
+                        self.calcInit()
+                        self.firstCalc = False
+                columns = [c for c in self.df.columns if c not in ["date", "time"]]
+                if stations is None:
+                        route_stops = routeData().get(self.line, self.direction)['id'].values
+                        stations = columns + [s for s in route_stops if s not in columns]
+                present = [s for s in stations if s in columns]
+                hour = self._hourBucket()
+                date_codes = pd.factorize(self.df["date"].values)[0]
+                ticks = self.df[present].values.astype(float)
+                row_i, station_i = np.nonzero(~np.isnan(ticks) & (hour >= 0)[:, None])
+                tick = ticks[row_i, station_i].astype(int)
+                hour_i = hour[row_i]
+                date_i = date_codes[row_i]
+                order = np.lexsort((tick, date_i, hour_i, station_i))
+                station_i, hour_i, date_i, tick = station_i[order], hour_i[order], date_i[order], tick[order]
+                same_run = (station_i[1:] == station_i[:-1]) & (hour_i[1:] == hour_i[:-1]) & (date_i[1:] == date_i[:-1])
+                headways = pd.DataFrame({'station':station_i[1:][same_run], 'hour':hour_i[1:][same_run],
+                                         'headway':(tick[1:] - tick[:-1])[same_run]/60.})
+                described = headways.groupby(['station','hour'])['headway'].describe()
+
+                self.headwayStats = {}
+                for i, station in enumerate(present):
+                        self.headwayStats[station] = {}
+                        for h in range(24):
+                                if (i, h) in described.index:
+                                        self.headwayStats[station][h] = described.loc[(i, h)]
+                                else:
+                                        self.headwayStats[station][h] = pd.Series([]).astype(float).describe()
+                        self.computedSeries[station] = dict([(h, float(self.headwayStats[station][h]['mean']))
+                                                             if self.headwayStats[station][h]['count'] > 0 else (h, 0.)
+                                                             for h in range(24)])
+                for station in stations:
+                        if station not in columns:
+                                self.computedSeries[station] = dict([(h, 0.) for h in range(24)])
+                print self.ID,"computed headways for",len(present),"stations in bulk"
+                self.storeData()
+                return self.headwayStats
+
 # trip duraton as a function of stop
 class durationAggregator(aggregator):
+        archiveStats = SCALAR_STATS
+        archiveNull = None
+        liveDefault = 0.
+        queryScale = 1/60.
+
         def __init__(self, ll, dd, useComputed=True):
                 aggregator.__init__(self, ll, dd, useComputed)
                 self.ID = "durationAggregatorArchive_" + self.line + "_" + self.direction
                 self.db_filename = "data/." + self.ID + ".dict"
+                self.store_filename = "data/." + self.ID + STORE_EXT
                 self.loadData()
 
         def calcInit(self):
@@ -202,6 +533,19 @@ class durationAggregator(aggregator):
             self.df['min'] = self.df.drop(['date','time'],axis=1).min(axis=1)
             print self.ID, "local calcInit computed column with earliest stop time for each row"
 
+        def partialObservations(self, station, date_codes, slot):
+                ## secs since the trip's first stop, as calcInterval; negatives dropped
+                if station not in self.df.columns:
+                        return np.array([], dtype=int), np.array([])
+                diff = self.df[station].values.astype(float) - self.df['min'].values.astype(float)
+                with np.errstate(invalid='ignore'):
+                        row_i = np.nonzero((slot >= 0) & (diff >= 0))[0]
+                return row_i, diff[row_i]
+
+        def liveValue(self, sketch):
+                # observations are in seconds; the archive holds minutes
+                return sketch.mean/60.
+
         def calcInterval(self, hmin, hmax, station):
                 df_select = self.df[self.df["time"]>hmin]
                 df_select = df_select[df_select["time"]<hmax].astype(float)
@@ -0,0 +1,337 @@
+import BaseHTTPServer
+import SocketServer
+import filecmp
+import glob
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urlparse
+import numpy as np
+import pandas as pd
+
+import collect
+import aggregator
+import gtfs_realtime_pb2
+from dataEngine import systemManager, renderBuffer, routeObj
+from plotComposer import plotManager
+from plotInterfaces import dummyPlotInterface
+from streamManagers import FEED_DECODERS, FEED_COLUMNS, feedPoller, streamSimulator
+from systemData import routeData, stationLoc
+
+SAMPLE_CLEAN_FILES = "data/subway_data_1404840164_*_clean.csv"
+SAMPLE_STOPTIMES = "data/subway_data_1404840164_%s_%s_stoptimes.csv"
+
+def _repolled_records(fname, repolls=2, seed=0):
+    """Rebuild a raw-like partition from a _clean.csv file.
+
+    Each record is repeated repolls times with its timestamp nudged by one
+    poll interval (30 secs) either way, mimicking the duplicate reports the
+    live feed produces, so the reconcile step has something to drop.
+    """
+    df = pd.read_csv(fname, index_col=0)
+    rng = np.random.RandomState(seed)
+    copies = [df]
+    for k in range(repolls):
+        rep = df.copy()
+        rep['timestamp'] = rep['timestamp'] + 30*rng.randint(-1, 2, len(rep))
+        copies.append(rep)
+    df = pd.concat(copies).sort_values('timestamp', kind='mergesort')
+    df.index = np.arange(len(df))
+    return df
+
+def benchmark_reconcile(pattern=SAMPLE_CLEAN_FILES, engines=("loop", "grouped"), repolls=2):
+    """Time each collect reconcile engine on the sample data and check they agree."""
+    results = []
+    for fname in sorted(glob.glob(pattern)):
+        DL_dir = _repolled_records(fname, repolls)
+        trips = DL_dir['long_id'].unique()
+        stops = list(DL_dir['stop'].unique())
+        outputs = {}
+        timing = {}
+        for engine in engines:
+            t0 = time.time()
+            outputs[engine] = collect.RECONCILE_ENGINES[engine](DL_dir, trips, stops)
+            timing[engine] = time.time() - t0
+        reference = outputs[engines[0]]
+        for engine in engines[1:]:
+            dropIndex, latestRecord, isLate = outputs[engine]
+            assert sorted(dropIndex) == sorted(reference[0]), fname + " dropped rows differ for " + engine
+            assert latestRecord.astype(float).equals(reference[1].astype(float)), fname + " stoptimes differ for " + engine
+            assert isLate.astype(float).equals(reference[2].astype(float)), fname + " howlate differ for " + engine
+        print fname, len(DL_dir), "rows", ", ".join([e + " %.3fs" % timing[e] for e in engines])
+        results.append((fname, len(DL_dir), timing))
+    return results
+
+def write_sample_raw(fname, pattern=SAMPLE_CLEAN_FILES, repolls=2):
+    """Reassemble a raw feed csv, in timestamp order, from the sample partitions."""
+    frames = [_repolled_records(f, repolls)[collect.STANDARD_COLS] for f in sorted(glob.glob(pattern))]
+    raw = pd.concat(frames).sort_values('timestamp', kind='mergesort')
+    raw.to_csv(fname, index=False)
+    print "wrote",len(raw),"raw records to",fname
+    return fname
+
+def check_parallel_process(raw_fname=None, workers=4):
+    """Run collect.process serially and with a worker pool; assert the output files are identical."""
+    tmp = tempfile.mkdtemp(prefix="conductor_bench_")
+    try:
+        if raw_fname is None:
+            raw_fname = write_sample_raw(os.path.join(tmp, "raw.csv"))
+        timing = {}
+        for mode, n in [("serial", None), ("parallel", workers)]:
+            os.mkdir(os.path.join(tmp, mode))
+            t0 = time.time()
+            collect.process(raw_fname, os.path.join(tmp, mode, "out_"), workers=n)
+            timing[mode] = time.time() - t0
+        serial_files = sorted(os.listdir(os.path.join(tmp, "serial")))
+        assert serial_files == sorted(os.listdir(os.path.join(tmp, "parallel"))), "output file sets differ"
+        match, mismatch, errors = filecmp.cmpfiles(os.path.join(tmp, "serial"), os.path.join(tmp, "parallel"),
+                                                   serial_files, shallow=False)
+        assert len(mismatch) == 0 and len(errors) == 0, "outputs differ: " + str(mismatch + errors)
+        print len(match),"files identical; serial %.2fs, %d workers %.2fs" % (timing["serial"], workers, timing["parallel"])
+        return timing
+    finally:
+        shutil.rmtree(tmp)
+
+def sample_feed_snapshots(pattern=SAMPLE_CLEAN_FILES, n_snapshots=50, window=600, stops_per_trip=10):
+    """Serialized FeedMessages at n_snapshots poll times spread over the sample partitions.
+
+    The _clean.csv files only keep a record when a trip's next stop changes, whereas each live
+    snapshot lists every running trip; a snapshot here holds the latest record of every trip
+    seen in the preceding window seconds. Each trip gets stops_per_trip stop_time_updates (the
+    live feed lists every remaining stop) and a vehicle entity alongside its trip update.
+    """
+    df = pd.concat([pd.read_csv(f, index_col=0) for f in sorted(glob.glob(pattern))])
+    df = df.sort_values('timestamp', kind='mergesort')
+    times = df['timestamp'].unique()
+    snapshots = []
+    for timestamp in times[np.linspace(0, len(times) - 1, n_snapshots).astype(int)]:
+        records = df[(df['timestamp'] > timestamp - window) & (df['timestamp'] <= timestamp)]
+        records = records.drop_duplicates('trip_id', keep='last')
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.header.gtfs_realtime_version = "1.0"
+        feed.header.timestamp = int(timestamp)
+        for i, (trip_id, start_date, stop, arrive, depart) in enumerate(zip(records['trip_id'], records['start_date'],
+                                                                           records['stop'], records['arrive'], records['depart'])):
+            entity = feed.entity.add()
+            entity.id = str(2*i)
+            entity.trip_update.trip.trip_id = trip_id
+            entity.trip_update.trip.start_date = str(start_date)
+            for k in range(stops_per_trip):
+                update = entity.trip_update.stop_time_update.add()
+                update.stop_id = stop
+                update.arrival.time = int(arrive) + 120*k
+                update.departure.time = int(depart) + 120*k
+            vehicle = feed.entity.add()
+            vehicle.id = str(2*i + 1)
+            vehicle.vehicle.trip.trip_id = trip_id
+        snapshots.append(feed.SerializeToString())
+    return snapshots
+
+def benchmark_feed_decode(feed_files=None, engines=("append", "columnar"), max_snapshots=50):
+    """Time each streamManagers feed decoder on recorded snapshots and check they agree.
+
+    feed_files is a glob of serialized FeedMessages (one snapshot per file); by default the
+    snapshots are rebuilt from the sample partitions.
+    """
+    if feed_files is None:
+        snapshots = sample_feed_snapshots(n_snapshots=max_snapshots)
+    else:
+        snapshots = [open(f, 'rb').read() for f in sorted(glob.glob(feed_files))[:max_snapshots]]
+    timing = dict([(engine, 0.) for engine in engines])
+    records = 0
+    for snapshot in snapshots:
+        feed = gtfs_realtime_pb2.FeedMessage()
+        feed.ParseFromString(snapshot)
+        outputs = {}
+        for engine in engines:
+            t0 = time.time()
+            outputs[engine] = FEED_DECODERS[engine](feed)
+            timing[engine] += time.time() - t0
+        reference = outputs[engines[0]]
+        for engine in engines[1:]:
+            assert len(outputs[engine]) == len(reference), "record counts differ for " + engine
+            if len(reference) > 0:
+                assert list(outputs[engine].columns) == FEED_COLUMNS, "columns differ for " + engine
+                assert outputs[engine].equals(reference), "records differ for " + engine
+        records += len(reference)
+    print len(snapshots), "snapshots,", records, "records;", ", ".join([e + " %.3fs" % timing[e] for e in engines])
+    return timing
+
+class _feedStubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class _feedStubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        feed_id = urlparse.parse_qs(urlparse.urlsplit(self.path).query).get('feed_id', [None])[0]
+        with server.lock:
+            served = server.served.setdefault(feed_id, 0)
+            server.served[feed_id] = served + 1
+            server.connections.setdefault(feed_id, set()).add(self.client_address)
+        if feed_id not in server.snapshots or served < server.fail_first.get(feed_id, 0):
+            body = "unavailable"
+            self.send_response(503)
+        else:
+            snapshots = server.snapshots[feed_id]
+            body = snapshots[(served - server.fail_first.get(feed_id, 0)) % len(snapshots)]
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_feed_snapshots(snapshots, fail_first={}):
+    """Local HTTP stand-in for the MTA feed endpoint, on a free port.
+
+    snapshots maps feed_id to a list of serialized FeedMessages, served in rotation;
+    the first fail_first[feed_id] requests for a feed get HTTP 503. Returns the server
+    (stop it with shutdown()) and the url to hand to feedConnection/feedPoller.
+    """
+    server = _feedStubServer(("127.0.0.1", 0), _feedStubHandler)
+    server.snapshots = snapshots
+    server.fail_first = fail_first
+    server.served = {}
+    server.connections = {}
+    server.lock = threading.Lock()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%d/mta_esi.php?key=stub" % server.server_address[1]
+
+def check_feed_poller(rounds=6, interval=0.2):
+    """Poll two stub feeds (lines 1-3 and 4-6 of the sample data), one failing at first, and
+    check that merged snapshots arrive, the failing feed joins after backing off, and each
+    feed is read over a single kept-alive connection."""
+    snapshots = {"1": sample_feed_snapshots("data/subway_data_1404840164_[123]_*_clean.csv", n_snapshots=rounds),
+                 "2": sample_feed_snapshots("data/subway_data_1404840164_[456]_*_clean.csv", n_snapshots=rounds)}
+    server, url = serve_feed_snapshots(snapshots, fail_first={"2": 2})
+    poller = feedPoller(["1", "2"], interval=interval, url=url, backoff_base=interval).start()
+    try:
+        t0 = time.time()
+        merged = [poller.queue.get(timeout=30.) for k in range(rounds)]
+        elapsed = time.time() - t0
+    finally:
+        poller.stop()
+        server.shutdown()
+        server.server_close()
+    lines = [set([collect.get_line(trip_id) for trip_id in records['trip_id']]) for timestamp, records in merged]
+    assert lines[0] <= set("123"), "feed 2 should still be failing in the first round"
+    assert lines[-1] == set("123456"), "feed 2 never rejoined the merged snapshot: " + str(lines[-1])
+    assert all([list(records.columns) == FEED_COLUMNS for timestamp, records in merged])
+    for feed_id in ["1", "2"]:
+        assert len(server.connections[feed_id]) == 1, "feed " + feed_id + " opened " + str(len(server.connections[feed_id])) + " connections"
+    print rounds, "merged snapshots in %.2fs;" % elapsed, "requests served", server.served, "; records per snapshot", [len(r) for t, r in merged]
+    return merged
+
+def check_render_buffer():
+    """A frame kept from renderBuffer.frame() keeps its labels, and each label its row, after later
+    removes and writes move rows around the buffer."""
+    fields = ['x', 'y', 'color']
+    buf = renderBuffer(fields, capacity=2)
+    buf.write(['a', 'b', 'c'], [[1., 1., 'red'], [2., 2., 'green'], [3., 3., 'blue']])
+    kept = buf.frame()
+    snap = kept.copy()
+    labels = list(kept.index)
+    buf.remove('a')
+    buf.write(['d'], [[4., 4., 'black']])
+    assert list(kept.index) == labels, "retained frame relabelled: " + str(list(kept.index))
+    assert list(snap.index) == labels, "copy of a retained frame relabelled: " + str(list(snap.index))
+    assert snap.loc['c', 'x'] == 3. and snap.loc['a', 'x'] == 1., "copied rows lost their labels"
+    current = buf.frame()
+    assert sorted(current.index) == ['b', 'c', 'd'], str(list(current.index))
+    assert [current.loc[key, 'x'] for key in ['b', 'c', 'd']] == [2., 3., 4.]
+    print "renderBuffer frames keep their labels across remove and write"
+
+def check_fetch_failed():
+    """With no stoptimes to compute from, a lazy series resolves to the defaults stored in
+    computedSeries, so live observations made afterwards show through it."""
+    agg = aggregator.frequencyAggregator('Z', 'N')
+    agg.loadData()
+    agg.enableOnline(minCount=2)
+    lazy = agg.fetchLazy('no-such-stop')
+    assert lazy.resolve() is agg.computedSeries['no-such-stop'], "defaults not stored for the token"
+    assert lazy.get(8) == agg.liveDefault
+    agg.observe('no-such-stop', 8, 100.)
+    agg.observe('no-such-stop', 8, 120.)
+    assert lazy.get(8) == agg.computedSeries['no-such-stop'][8] != agg.liveDefault, "live update not seen"
+    print "fetchFailed series pick up live observations"
+
+def check_null_stats():
+    """A segment with no stoptimes reports NULL_STATS travel times: 240 secs at the median, for
+    the lazy series and for a late train placed on a route that holds it."""
+    agg = aggregator.segmentAggregator('Z', 'N')
+    route = routeData().get('1', 'N').iloc[0]
+    token = (route['origin'], route['destination'])
+    stats = agg.fetchLazy(token)
+    assert stats.get(8, 0.).get('50%', 0.) == 240, str(stats.get(8))
+    obj = routeObj('check', route['origin'], route['destination'], stationLoc(), stats=stats)
+    t_start = time.mktime((2014, 7, 11, 8, 30, 0, 0, 0, -1))
+    obj.addTrain('check_trip', t_start, t_start - 60)
+    assert obj.trainsOnRoute['check_trip'][1] - t_start == 240, str(obj.trainsOnRoute['check_trip'])
+    print "fetchFailed segments report", stats.get(8, 0.).get('50%', 0.), "secs at the median"
+
+def check_query_matches_calcSeries(line='6', direction='N', n_segments=10):
+    """query() at 60 minute buckets agrees with calcSeries on count, min and max for each hour.
+
+    Runs in a temporary directory whose stoptimes master is the sample stoptimes table for line
+    and direction, so no archive under data/ is read or written.
+    """
+    cwd = os.getcwd()
+    tmp = tempfile.mkdtemp(prefix="conductor_bench_")
+    try:
+        os.mkdir(os.path.join(tmp, "data"))
+        os.mkdir(os.path.join(tmp, "stoptimes"))
+        shutil.copy(SAMPLE_STOPTIMES % (line, direction),
+                    os.path.join(tmp, "stoptimes", "master." + line + "_" + direction + ".concat.csv"))
+        os.chdir(tmp)
+        agg = aggregator.segmentAggregator(line, direction)
+        agg.calcInit()
+        agg.firstCalc = False
+        stops = [c for c in agg.df.columns if c not in ("date", "time")]
+        tokens = zip(stops[:n_segments], stops[1:n_segments + 1])
+        on_the_hour = (agg.df["time"] == np.floor(agg.df["time"])).sum()
+        for token in tokens:
+            expected = agg.calcSeries(token)
+            answer = agg.query(token, bucketMinutes=60)
+            for hour in range(24):
+                for stat in ['count', 'min', 'max']:
+                    want, got = expected[hour][stat], answer[hour][stat]
+                    assert (np.isnan(want) and np.isnan(got)) or np.isclose(want, got), \
+                        "%s hour %d %s: calcSeries %s, query %s" % (str(token), hour, stat, want, got)
+        print "query(60) matches calcSeries for",len(tokens),"segments;",on_the_hour,"trips start on the hour"
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+def benchmark_replay(pattern=SAMPLE_CLEAN_FILES, lines=['1','2','3','4','5','6'], start_hour=6., hours=2.):
+    """End-to-end throughput: replay hours of the sample partitions, from start_hour hours into the
+    recording, through streamSimulator, systemManager and dummyPlotInterface on a virtual clock."""
+    tmp = tempfile.mkdtemp(prefix="conductor_bench_")
+    try:
+        fname = os.path.join(tmp, "replay.csv")
+        records = pd.concat([pd.read_csv(f, index_col=0)[collect.STANDARD_COLS] for f in sorted(glob.glob(pattern))])
+        records.sort_values('timestamp', kind='mergesort').to_csv(fname, index=False)
+        stream = streamSimulator(fname)
+        boss = plotManager(systemManager(lines, ['N','S']), stream, dummyPlotInterface())
+        boss.setLifetime(3600.*hours)
+        return boss.replay(use_T0=stream.T0 + 3600.*start_hour)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == "__main__":
+    benchmark_reconcile()
+    check_parallel_process()
+    benchmark_feed_decode()
+    check_feed_poller()
+    check_render_buffer()
+    check_fetch_failed()
+    check_null_stats()
+    check_query_matches_calcSeries()
+    benchmark_replay()
@@ -1,8 +1,11 @@
 import pandas as pd
 import numpy as np
 import time
+from collections import OrderedDict
+from multiprocessing import Pool
 from string import lower
 from stations import _get_stops, get_stop_dict, get_line, stop_for
+from columnStore import write_stop_table, write_records, csv_to_parquet
 
 LEX_lines = ['4','5','6']
 
@@ -14,12 +17,12 @@ def load_df(fname="default", setcols=['timestamp', 'id', 'stop']):
 
     df = pd.read_csv(fname)
     if len(setcols) != len(df.columns):
-	    print "load_df Error: DataFrame has",len(df.columns),"columns"
-	    print "Length does not match specified column names",setcols
-	    return None
+            print "load_df Error: DataFrame has",len(df.columns),"columns"
+            print "Length does not match specified column names",setcols
+            return None
     df.columns = setcols
     # extract the train line from id
-    df['line'] = map(lambda x: x.split("_")[1][0], df['id'])
+    df['line'] = map(get_line, df['id'])
     return df
 
 def filter_stops(df, stops=["631N"], lines=['4','5']):
@@ -56,13 +59,13 @@ def nice_time(t, military=True):
     suffix = ""
     if not military:
         if hh<12:
-	    suffix = "AM"
+            suffix = "AM"
             if hh == 0:
                 hh = hh + 12
         else:
             suffix = "PM"
             if hh > 12:
-	        hh = hh - 12
+                hh = hh - 12
     return str(hh) + ":" + mm + " " + suffix
 
 def df_stop_frequency(direction, for_lines=['4','5','6'], fname="default", write_df_root="stopFreq", dt=120):
@@ -79,25 +82,25 @@ def df_stop_frequency(direction, for_lines=['4','5','6'], fname="default", write
                 print "Specified direction",direction,"not recognized; forcing NORTH"
         #station_codes = get_stop_dict(direction)
         times = D['timestamp'].unique()
-	t_max = times.max()
-	t_min = times.min()
-	print t_min,t_max
-	nbins = int((t_max - t_min)/dt) + 1
-	set_index = [int(t_min+n*dt) for n in range(nbins)]
+        t_max = times.max()
+        t_min = times.min()
+        print t_min,t_max
+        nbins = int((t_max - t_min)/dt) + 1
+        set_index = [int(t_min+n*dt) for n in range(nbins)]
         stops = D['stop'].unique()
-	print "Filtered DF contains stops",stops
-	df_freq = pd.DataFrame(index=set_index, columns=stops)
-	df_freq = df_freq.fillna(0.)
+        print "Filtered DF contains stops",stops
+        df_freq = pd.DataFrame(index=set_index, columns=stops)
+        df_freq = df_freq.fillna(0.)
 
-	for i in D.index:
-		t_bin = int((D.loc[i,'timestamp'] - t_min)/dt)*dt + int(t_min)
-		df_freq.loc[t_bin, D.loc[i,'stop']] = df_freq.loc[t_bin, D.loc[i,'stop']] + 1
-	df_freq.to_csv(write_df_root+".csv")
-	return df_freq
+        for i in D.index:
+                t_bin = int((D.loc[i,'timestamp'] - t_min)/dt)*dt + int(t_min)
+                df_freq.loc[t_bin, D.loc[i,'stop']] = df_freq.loc[t_bin, D.loc[i,'stop']] + 1
+        df_freq.to_csv(write_df_root+".csv")
+        return df_freq
 
 def df_trips_by_column(direction, for_lines=['4','5','6'], fname="default", write_df_root="tripData"):
         D = load_df(fname)
-	return df_trips_by_column(D, direction=direction, for_lines=for_lines, fname=fname, write_df_root=write_df_root)
+        return df_trips_by_column(D, direction=direction, for_lines=for_lines, fname=fname, write_df_root=write_df_root)
 
 def df_trips_by_column(D, direction="N", for_lines=['4','5','6'], fname="default", write_df_root="tripData"):
         D['tref'] = D['timestamp'].map(lambda t: get_TOD_reference(t))
@@ -135,7 +138,7 @@ def df_trips_by_column(D, direction="N", for_lines=['4','5','6'], fname="default
                 for stop in D_trip['stop'].unique():
                         D_trip_for_stop = D_trip[D_trip['stop']==stop]
                         tripCol.loc[stop,trip] = D_trip_for_stop['timestamp'].max()
-			stopCounts.loc[stop,trip] = len(D_trip_for_stop)
+                        stopCounts.loc[stop,trip] = len(D_trip_for_stop)
                 trip_time = tripCol.loc[station_codes[stop_for(l,endpoint)],trip] - \
                         tripCol.loc[station_codes[stop_for(l,origin)],trip]
                 tripCol.loc['trip_time',trip] = trip_time
@@ -166,80 +169,316 @@ def update_depart_time(v):
 		return v['depart']
 	return v['arrive']
 
-def process(fname, file_root=None):
+def _reconcile_loop(DL_dir, trips, stops):
+	"""Reference implementation: walk every row and keep the latest record per (trip, stop).
+
+	Returns the list of dropped row labels and the stoptimes and howlate DataFrames.
+	Kept for cross-checking _reconcile_grouped; too slow for a full day of data.
+	"""
+	latestRecord = pd.DataFrame(index=trips, columns=stops)
+	isLate = pd.DataFrame(index=trips, columns=stops)
+	keepIndex = pd.DataFrame(index=trips, columns=stops)
+	dropIndex = []
+	for i in DL_dir.index:
+		timestamp = DL_dir.loc[i,'timestamp']
+		stop = DL_dir.loc[i,'stop']
+		trip_id = DL_dir.loc[i,'long_id']
+		scheduled = DL_dir.loc[i,'depart']
+		if np.isnan(latestRecord.loc[trip_id,stop]):
+			latestRecord.loc[trip_id,stop] = timestamp
+			keepIndex.loc[trip_id,stop] = i
+			isLate.loc[trip_id,stop] = timestamp - scheduled
+		else:
+			old_t = latestRecord.loc[trip_id,stop]
+			old_i = keepIndex.loc[trip_id,stop]
+			if timestamp > old_t:
+				dropIndex.append(old_i)
+				latestRecord.loc[trip_id,stop] = timestamp
+				keepIndex.loc[trip_id,stop] = i
+				isLate.loc[trip_id,stop] = timestamp - scheduled
+			else:
+				dropIndex.append(i)
+	return dropIndex, latestRecord, isLate
+
+def _pivot_records(trip_codes, stop_cols, values, trips, stops):
+	"""Scatter one value per (trip, stop) into a trips x stops frame.
+	An object array keeps integer timestamps integral when written to csv, as the loop did."""
+	grid = np.empty((len(trips), len(stops)), dtype=object)
+	grid.fill(np.nan)
+	grid[trip_codes, stop_cols] = values
+	return pd.DataFrame(grid, index=trips, columns=stops)
+
+def _latest_positions(trip_codes, stop_codes, timestamps):
+	"""Positions of the record to keep for each (trip, stop): the latest timestamp,
+	and the earliest row among equal timestamps, as the row-by-row loop decides."""
+	n = len(timestamps)
+	position = np.arange(n)
+	order = np.lexsort((position, -timestamps, stop_codes, trip_codes))
+	first = np.ones(n, dtype=bool)
+	first[1:] = (trip_codes[order][1:] != trip_codes[order][:-1]) | \
+		(stop_codes[order][1:] != stop_codes[order][:-1])
+	return np.sort(order[first])
+
+def _reconcile_grouped(DL_dir, trips, stops):
+	"""Vectorized equivalent of _reconcile_loop.
+
+	A single lexsort orders rows by trip, stop, descending timestamp and original position,
+	so the first row of each (trip, stop) run is the record the loop would keep.
+	"""
+	trip_codes = pd.Index(trips).get_indexer(DL_dir['long_id'].values)
+	stop_codes = pd.Index(stops).get_indexer(DL_dir['stop'].values)
+	timestamps = DL_dir['timestamp'].values
+	keep = _latest_positions(trip_codes, stop_codes, timestamps)
+	dropped = np.ones(len(DL_dir), dtype=bool)
+	dropped[keep] = False
+	dropIndex = list(DL_dir.index[dropped])
+
+	howlate = timestamps[keep] - DL_dir['depart'].values[keep]
+	latestRecord = _pivot_records(trip_codes[keep], stop_codes[keep], timestamps[keep], trips, stops)
+	isLate = _pivot_records(trip_codes[keep], stop_codes[keep], howlate, trips, stops)
+	return dropIndex, latestRecord, isLate
+
+RECONCILE_ENGINES = {"loop": _reconcile_loop, "grouped": _reconcile_grouped}
+
+STANDARD_COLS = ['timestamp','trip_id','start_date','stop','arrive','depart']
+EXCLUDE_LINES = [".","G"]
+
+def _prepare_records(D):
+	"""Name the raw feed columns and derive line, tref and long_id for each record."""
+	D.columns = STANDARD_COLS
+	D['line'] = D['trip_id'].map(get_line)
+	D['tref'] = D['timestamp'].map(lambda t: get_TOD_reference(t))
+	D['long_id'] = D['trip_id'] + "::" + D['tref'].astype('string')
+	return D
+
+def _reconcile_departures(DL_dir):
+	"""Flag holds, take the later of arrive/depart as the departure and flag late records."""
+	DL_dir['hold'] = DL_dir['depart'] > DL_dir['arrive']
+	# same rule as update_depart_time, applied to whole columns
+	DL_dir['depart'] = np.where(DL_dir['hold'], DL_dir['depart'], DL_dir['arrive'])
+	DL_dir['late'] = DL_dir['timestamp'] > (DL_dir['depart'])
+	return DL_dir
+
+def _process_partition((DL_dir, l, direction, stops, file_root, engine)):
+	"""Reconcile one line/direction partition and write its four csv files.
+	Takes a single tuple so it can be handed to Pool.imap."""
+	## pre-process
+	print "Pre-processing data for line",l,"direction",direction
+	trips = DL_dir['long_id'].unique()
+	print "Reconciling arrive and depart data"
+	DL_dir = _reconcile_departures(DL_dir)
+
+	DL_dir.to_csv(file_root + l + "_" + direction + "_whole.csv")
+	print "Wrote DataFrame",file_root + l + "_" + direction + "_whole.csv"
+	print "Now processing data frames for line",l,direction,"with engine",engine
+	dropIndex, latestRecord, isLate = RECONCILE_ENGINES[engine](DL_dir, trips, stops)
+	print "assembled records to drop",len(dropIndex)
+	DLdrop = DL_dir.drop(dropIndex,axis=0)
+	DLdrop.to_csv(file_root + l + "_" + direction + "_clean.csv")
+	print "Wrote DataFrame",file_root + l + "_" + direction + "_clean.csv"
+	latestRecord.to_csv(file_root + l + "_" + direction + "_stoptimes.csv")
+	print "Wrote DataFrame",file_root + l + "_" + direction + "_stoptimes.csv"
+	isLate.to_csv(file_root + l + "_" + direction + "_howlate.csv")
+	print "Wrote DataFrame",file_root + l + "_" + direction + "_howlate.csv"
+	## typed columnar copies for downstream readers (skipped if pyarrow is not installed)
+	write_records(DL_dir, file_root + l + "_" + direction + "_whole")
+	write_records(DLdrop, file_root + l + "_" + direction + "_clean")
+	write_stop_table(latestRecord, file_root + l + "_" + direction + "_stoptimes")
+	write_stop_table(isLate, file_root + l + "_" + direction + "_howlate")
+	return l, direction, len(DL_dir), len(dropIndex)
+
+def _partitions(D, file_root, engine):
+	"""Yield the work item for each line/direction partition of the prepared records."""
+	lines = D['line'].unique()
+	lines = [l for l in lines if l not in EXCLUDE_LINES]
+	print "Collected data for subway lines",lines
+	for l in lines:
+		DL = D[D['line']==l]
+		all_stops = DL['stop'].unique()
+		for direction in ["N","S"]:
+			stops = [s for s in all_stops if s[-1]==direction]
+			DL_dir = DL[DL['stop'].str[-1]==direction]
+			yield DL_dir, l, direction, stops, file_root, engine
+
+def process(fname, file_root=None, engine="grouped", chunksize=None, t_expire=3600., workers=None):
+	"""Split raw feed records by line and direction and write the
+	_whole, _clean, _stoptimes and _howlate csv files for each.
+
+	engine selects how duplicate records per (trip, stop) are reconciled:
+	"grouped" (default, vectorized) or "loop" (the original row-by-row walk).
+	Both produce identical output.
+
+	Partitions are independent; with workers > 1 each one is reconciled and written
+	by a process from a multiprocessing pool. Output is identical to the serial run.
+
+	If chunksize is given the raw file is streamed chunksize rows at a time
+	(see process_chunked); workers is ignored in that mode.
+	"""
 	tstamp = time.time()
 	if not file_root:
 		file_root = "subway_data_" + str(int(tstamp)) + "_"
+	if chunksize:
+		return process_chunked(fname, file_root, chunksize, t_expire)
 	D = pd.read_csv(fname)
 	print "Read in raw data:",np.shape(D)
-	standard_cols = ['timestamp','trip_id','start_date','stop','arrive','depart']
-	D.columns = standard_cols
-	D['line'] = D['trip_id'].map(lambda x: x.split("_")[1][0])
-	lines = D['line'].unique()
-	lines = [l for l in lines if l not in [".","G"]]
-	print "Collected data for subway lines",lines
-        D['tref'] = D['timestamp'].map(lambda t: get_TOD_reference(t))
-        D['long_id'] = D['trip_id'] + "::" + D['tref'].astype('string')
+	D = _prepare_records(D)
+
+	if workers and workers > 1:
+		pool = Pool(workers)
+		try:
+			summary = list(pool.imap(_process_partition, _partitions(D, file_root, engine)))
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		summary = [_process_partition(task) for task in _partitions(D, file_root, engine)]
+	for l, direction, n_records, n_dropped in summary:
+		print "line",l,"direction",direction,":",n_records,"records,",n_dropped,"dropped"
+	return summary
+
+class _partitionStream():
+	"""Running per-(trip, stop) state for one line/direction partition during a chunked ingest.
+
+	Trips are held in order of first appearance and each is written out once it has gone
+	t_expire seconds without a record, so memory is bounded by the number of trips active
+	within that window rather than by the length of the raw file.
+	"""
+	def __init__(self, file_root, line, direction, stops, t_expire):
+		self.file_root = file_root + line + "_" + direction + "_"
+		self.stops = stops
+		self.stop_index = pd.Index(stops)
+		self.t_expire = t_expire
+		self.trips = OrderedDict()
+		self.columns = None
+		self.written = {}
+		self.n_records = 0
+		self.n_kept = 0
+
+	def _write(self, df, kind):
+		fname = self.file_root + kind + ".csv"
+		if self.written.get(kind):
+			df.to_csv(fname, mode='a', header=False)
+		else:
+			df.to_csv(fname)
+			self.written[kind] = True
+
+	def update(self, DL_dir):
+		"""Merge one chunk of this partition's records into the running state."""
+		if len(DL_dir) == 0:
+			return
+		self.columns = DL_dir.columns
+		self.n_records += len(DL_dir)
+		self._write(DL_dir, "whole")
+		trip_ids = DL_dir['long_id'].values
+		for trip in pd.unique(trip_ids):
+			if trip not in self.trips:
+				self.trips[trip] = {'last_seen':None, 'stops':{}}
+		timestamps = DL_dir['timestamp'].values
+		keep = _latest_positions(pd.factorize(trip_ids)[0],
+					 self.stop_index.get_indexer(DL_dir['stop'].values),
+					 timestamps)
+		howlate = timestamps[keep] - DL_dir['depart'].values[keep]
+		for label, trip, stop, t, late, row in zip(DL_dir.index[keep], trip_ids[keep],
+							   DL_dir['stop'].values[keep], timestamps[keep],
+							   howlate, DL_dir.values[keep]):
+			record = self.trips[trip]
+			record['last_seen'] = max(record['last_seen'], t)
+			old = record['stops'].get(stop)
+			# records already held precede this chunk, so only a strictly later one replaces them
+			if old is None or t > old[0]:
+				record['stops'][stop] = (t, late, label, row)
+
+	def flush(self, t_now=None):
+		"""Write out every trip that has expired by t_now (all trips if None), in order of first appearance."""
+		# scan all held trips: a long-lived trip at the head must not hold back later ones that have ended
+		expired = [trip for trip, record in self.trips.iteritems()
+			   if t_now is None or t_now - record['last_seen'] >= self.t_expire]
+		done = [(trip, self.trips.pop(trip)['stops']) for trip in expired]
+		if len(done) > 0:
+			self._write_trips(done)
+		return len(done)
 
+	def _write_trips(self, done):
+		trips = [trip for trip, stop_records in done]
+		trip_codes, stop_cols, times, lates, labels, rows = [], [], [], [], [], []
+		for code, (trip, stop_records) in enumerate(done):
+			for stop, (t, late, label, row) in stop_records.iteritems():
+				trip_codes.append(code)
+				stop_cols.append(self.stop_index.get_loc(stop))
+				times.append(t)
+				lates.append(late)
+				labels.append(label)
+				rows.append(row)
+		trip_codes = np.array(trip_codes)
+		stop_cols = np.array(stop_cols)
+		self._write(_pivot_records(trip_codes, stop_cols, np.array(times), trips, self.stops), "stoptimes")
+		self._write(_pivot_records(trip_codes, stop_cols, np.array(lates), trips, self.stops), "howlate")
+		self._write(pd.DataFrame(rows, index=labels, columns=self.columns).sort_index(), "clean")
+		self.n_kept += len(labels)
+
+	def finish(self):
+		"""Flush every remaining trip; partitions that never saw a record still get (empty) files."""
+		self.flush()
+		if not self.written.get("whole"):
+			self.columns = STANDARD_COLS + ['line','tref','long_id','hold','late']
+			for kind in ["whole", "clean"]:
+				self._write(pd.DataFrame(columns=self.columns), kind)
+			for kind in ["stoptimes", "howlate"]:
+				self._write(pd.DataFrame(index=[], columns=self.stops), kind)
+		for kind in ["whole", "clean", "stoptimes", "howlate"]:
+			print "Wrote DataFrame",self.file_root + kind + ".csv"
+		for kind in ["whole", "clean"]:
+			csv_to_parquet(self.file_root + kind, "records")
+		for kind in ["stoptimes", "howlate"]:
+			csv_to_parquet(self.file_root + kind, "stops")
+
+def _partition_stops(fname, chunksize):
+	"""First pass over a raw feed file: the lines present and the stops seen on each,
+	both in order of first appearance, as the in-memory process sees them."""
+	line_stops = OrderedDict()
+	for chunk in pd.read_csv(fname, usecols=[1,3], chunksize=chunksize):
+		pairs = pd.DataFrame({'line':chunk.iloc[:,0].map(get_line),
+				      'stop':chunk.iloc[:,1]}).drop_duplicates()
+		for l, stop in zip(pairs['line'].values, pairs['stop'].values):
+			stops = line_stops.setdefault(l, OrderedDict())
+			stops[stop] = True
+	return line_stops
+
+def process_chunked(fname, file_root, chunksize=100000, t_expire=3600.):
+	"""Streaming version of process for raw files too large to hold in memory.
+
+	The raw csv is read chunksize rows at a time and only the latest record per active
+	(trip, stop) is kept; a trip is written out once no record for it has arrived for
+	t_expire seconds of feed time. The _whole file matches process exactly. The
+	_stoptimes and _howlate files hold the same rows, with trips in order of first
+	appearance within each flushed batch rather than globally, and the _clean file
+	holds the same records, ordered by row label within each batch. A record that turns up
+	for a trip after it has been written out starts a new row for that trip, so
+	t_expire should comfortably exceed the longest gap between reports for a live trip.
+	"""
+	line_stops = _partition_stops(fname, chunksize)
+	lines = [l for l in line_stops.keys() if l not in EXCLUDE_LINES]
+	print "Collected data for subway lines",lines
+	partitions = OrderedDict()
 	for l in lines:
-		DL = D[D['line']==l]
-		all_stops = DL['stop'].unique()
 		for direction in ["N","S"]:
-			stops = [s for s in all_stops if s[-1]==direction]
-			direction_mask = [s in stops for s in DL['stop']]
-			DL_dir = DL[direction_mask]
-			## pre-process
-			print "Pre-processing data for line",l,"direction",direction
-			#print DL_dir['stop'].unique()
-			trips = DL_dir['long_id'].unique()
-			times = DL_dir['timestamp'].unique()
-			print "Reconciling arrive and depart data"
-			DL_dir['hold'] = DL_dir['depart'] > DL_dir['arrive']
-			DL_dir['hold'].value_counts()
-			DL_dir['depart'] = DL_dir.apply(update_depart_time,axis=1)
-			DL_dir['late'] = DL_dir['timestamp'] > (DL_dir['depart'])
-
-			DL_dir.to_csv(file_root + l + "_" + direction + "_whole.csv")
-			print "Wrote DataFrame",file_root + l + "_" + direction + "_whole.csv"
-			print "Now processing data frames for line",l,direction
-			## the DataFrames we'll write
-			latestRecord = pd.DataFrame(index=trips, columns=stops)
-			isLate = pd.DataFrame(index=trips, columns=stops)
-			keepIndex = pd.DataFrame(index=trips, columns=stops)
-			dropIndex = []
-			######
-
-			## very slow loop - TODO: speedup (numba, other data structures?)
-			for i in DL_dir.index:
-				timestamp = DL_dir.loc[i,'timestamp']
-				stop = DL_dir.loc[i,'stop']
-				trip_id = DL_dir.loc[i,'long_id']
-				scheduled = DL_dir.loc[i,'depart']
-				#print i,timestamp,stop,trip_id
-				if np.isnan(latestRecord.loc[trip_id,stop]):
-					latestRecord.loc[trip_id,stop] = timestamp
-					keepIndex.loc[trip_id,stop] = i
-					isLate.loc[trip_id,stop] = timestamp - scheduled
-				else:
-					old_t = latestRecord.loc[trip_id,stop]
-					old_i = keepIndex.loc[trip_id,stop]
-					if timestamp > old_t:
-						dropIndex.append(old_i)
-						latestRecord.loc[trip_id,stop] = timestamp
-						keepIndex.loc[trip_id,stop] = i
-						isLate.loc[trip_id,stop] = timestamp - scheduled
-						# i,trip_id,stop,"replace",timestamp,">",old_t,old_i
-					else:
-						dropIndex.append(i)
-						#print i,trip_id,stop,"REJECT",timestamp,"<",old_t,old_i
-			print "assembled records to drop",len(dropIndex)
-			DLdrop = DL_dir.drop(dropIndex,axis=0)
-			DLdrop.to_csv(file_root + l + "_" + direction + "_clean.csv")
-			print "Wrote DataFrame",file_root + l + "_" + direction + "_clean.csv"
-			latestRecord.to_csv(file_root + l + "_" + direction + "_stoptimes.csv")
-			print "Wrote DataFrame",file_root + l + "_" + direction + "_stoptimes.csv"
-			isLate.to_csv(file_root + l + "_" + direction + "_howlate.csv")
-			print "Wrote DataFrame",file_root + l + "_" + direction + "_howlate.csv"
+			stops = [s for s in line_stops[l].keys() if s[-1]==direction]
+			partitions[(l,direction)] = _partitionStream(file_root, l, direction, stops, t_expire)
+
+	n_read = 0
+	for chunk in pd.read_csv(fname, chunksize=chunksize):
+		chunk = _prepare_records(chunk)
+		n_read += len(chunk)
+		t_now = chunk['timestamp'].max()
+		for (l, direction), stream in partitions.iteritems():
+			DL = chunk[chunk['line']==l]
+			stream.update(_reconcile_departures(DL[DL['stop'].str[-1]==direction]))
+			stream.flush(t_now)
+		print "Read",n_read,"raw records;",sum([len(p.trips) for p in partitions.values()]),"trips active"
+
+	for (l, direction), stream in partitions.iteritems():
+		print "Finishing line",l,"direction",direction,":",stream.n_records,"records,",stream.n_kept,"kept"
+		stream.finish()
 
 if __name__ == "__main__":
 	print "Calling process on mta_data_v2.2014.7_agg.csv"
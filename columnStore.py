@@ -0,0 +1,125 @@
+import os
+import numpy as np
+import pandas as pd
+
+## Typed columnar copies of the tables collect.process writes.
+## The wide trips x stops tables (_stoptimes, _howlate) are mostly empty cells; in parquet each
+## stop is a nullable int64 column, so empty cells cost almost nothing and a reader can project
+## just the stations it needs. Trip and stop ids are dictionary encoded on disk and come back
+## as pandas categoricals. The csv files are still written and are used whenever pyarrow is
+## not installed or no parquet copy exists.
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    HAVE_PARQUET = True
+except ImportError:
+    HAVE_PARQUET = False
+
+PARQUET_EXT = ".parquet"
+CSV_EXT = ".csv"
+
+INDEX_COL = "long_id"
+INT_RECORD_COLS = ['timestamp', 'start_date', 'arrive', 'depart', 'tref']
+BOOL_RECORD_COLS = ['hold', 'late']
+ID_RECORD_COLS = ['trip_id', 'stop', 'line', 'long_id']
+
+def has_parquet(path_root):
+    return HAVE_PARQUET and os.path.exists(path_root + PARQUET_EXT)
+
+def _int_array(values):
+    values = pd.to_numeric(pd.Series(values), errors='coerce').values.astype(float)
+    missing = np.isnan(values)
+    values[missing] = 0
+    return pa.array(values.astype(np.int64), mask=missing, type=pa.int64())
+
+def _stop_table(df):
+    columns = [pa.array([str(i) for i in df.index], type=pa.string()).dictionary_encode()]
+    names = [INDEX_COL]
+    for stop in df.columns:
+        columns.append(_int_array(df[stop].values))
+        names.append(str(stop))
+    return pa.Table.from_arrays(columns, names=names)
+
+def _records_table(df):
+    columns = [pa.array(np.asarray(df.index, dtype=np.int64), type=pa.int64())]
+    names = ["index"]
+    for col in df.columns:
+        if col in INT_RECORD_COLS:
+            columns.append(_int_array(df[col].values))
+        elif col in BOOL_RECORD_COLS:
+            columns.append(pa.array(df[col].values.astype(bool), type=pa.bool_()))
+        else:
+            columns.append(pa.array([str(v) for v in df[col].values], type=pa.string()))
+        names.append(str(col))
+    return pa.Table.from_arrays(columns, names=names)
+
+def write_stop_table(df, path_root):
+    """Write a trips x stops frame (stoptimes or howlate) as path_root.parquet."""
+    if not HAVE_PARQUET:
+        return None
+    pq.write_table(_stop_table(df), path_root + PARQUET_EXT)
+    return path_root + PARQUET_EXT
+
+def write_records(df, path_root):
+    """Write a per-record frame (whole or clean) as path_root.parquet."""
+    if not HAVE_PARQUET:
+        return None
+    pq.write_table(_records_table(df), path_root + PARQUET_EXT)
+    return path_root + PARQUET_EXT
+
+def csv_to_parquet(path_root, kind, chunksize=100000):
+    """Build the parquet copy of a csv written incrementally (see collect.process_chunked).
+    kind is "stops" for trips x stops tables and "records" for whole/clean tables."""
+    if not HAVE_PARQUET:
+        return None
+    to_table = _stop_table if kind == "stops" else _records_table
+    writer = None
+    try:
+        for chunk in pd.read_csv(path_root + CSV_EXT, index_col=0, chunksize=chunksize):
+            table = to_table(chunk)
+            if writer is None:
+                writer = pq.ParquetWriter(path_root + PARQUET_EXT, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+    return path_root + PARQUET_EXT
+
+def read_stop_table(path_root, stations=None, **csv_kwargs):
+    """Load a trips x stops table indexed by trip long_id, with float columns (NaN where empty).
+
+    stations restricts the load to those columns; stations absent from the table are skipped.
+    Falls back to path_root.csv (read with csv_kwargs) when there is no parquet copy.
+    """
+    if has_parquet(path_root):
+        columns = None
+        if stations is not None:
+            # keep the stored column order, as the csv path does
+            stations = set(stations)
+            columns = [INDEX_COL] + [s for s in pq.read_schema(path_root + PARQUET_EXT).names if s in stations]
+        df = pq.read_table(path_root + PARQUET_EXT, columns=columns).to_pandas()
+        df = df.set_index(INDEX_COL)
+        # the long_id dictionary is decoded back to plain strings, as read from csv; callers parse them
+        df.index = pd.Index(np.asarray(df.index), dtype=object)
+        df.index.name = None
+        return df.astype(float)
+    df = pd.read_csv(path_root + CSV_EXT, index_col=0, **csv_kwargs)
+    if stations is not None:
+        stations = set(stations)
+        df = df[[s for s in df.columns if s in stations]]
+    return df
+
+def read_records(path_root, columns=None):
+    """Load a whole/clean records table; trip and stop ids come back as categoricals."""
+    if has_parquet(path_root):
+        if columns is not None:
+            columns = ["index"] + list(columns)
+        df = pq.read_table(path_root + PARQUET_EXT, columns=columns,
+                           read_dictionary=[c for c in ID_RECORD_COLS if columns is None or c in columns]).to_pandas()
+        df = df.set_index("index")
+        df.index.name = None
+        return df
+    df = pd.read_csv(path_root + CSV_EXT, index_col=0)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
@@ -1,13 +1,17 @@
 import numpy as np
 import pandas as pd
+import bisect
+import heapq
 import math
+import os
 import time
 from collections import OrderedDict
 
-from stations import station_names
+from stations import station_names, trip_descriptor
 from collect import get_TOD_reference, nice_time
 from systemData import stationLoc, routeData
 from aggregator import frequencyAggregator, NULL_STATS, segmentAggregator, durationAggregator
+from aggregator import precompute as precompute_series
 
 from pyproj import Proj
 # EPSG Projection 2263 - NAD83 / New York Long Island (ftUS)
@@ -19,6 +23,33 @@ def _map_projection(lon, lat):
     x,y = _proj(lon, lat)
     return FEET_PER_METER*x, FEET_PER_METER*y
 
+## projected x/y of every stop, computed in one batch and kept on disk between runs
+STOPS_FILE = "stops_formatted.txt"
+GEOMETRY_CACHE = "data/.stops_projected.npz"
+_station_xy = None
+
+def _load_geometry(fname=STOPS_FILE, cache=GEOMETRY_CACHE):
+    """{stop_id: (x, y)} for every stop in fname, from cache unless fname is newer or the projection changed."""
+    if os.path.exists(cache) and os.path.getmtime(cache) >= os.path.getmtime(fname):
+        stored = np.load(cache)
+        if str(stored['epsg']) == EPSG_PROJECTION_CODE:
+            return dict(zip(stored['ids'], zip(stored['x'], stored['y'])))
+    stops = pd.read_csv(fname, index_col=0)
+    ids = np.array([str(i) for i in stops.index])
+    x, y = _map_projection(stops['lon'].values.astype(float), stops['lat'].values.astype(float))
+    try:
+        np.savez(cache, ids=ids, x=x, y=y, epsg=EPSG_PROJECTION_CODE)
+        print "projected",len(ids),"stops and cached them in",cache
+    except IOError as e:
+        print "could not write geometry cache",cache,e
+    return dict(zip(ids, zip(x, y)))
+
+def _station_projection(stop_id):
+    global _station_xy
+    if _station_xy is None:
+        _station_xy = _load_geometry()
+    return _station_xy[stop_id]
+
 ONE_BY_SIXTY = 1./60
 line_mult = 3
 Z_UP = np.array((0., 0., 1.))
@@ -66,9 +97,8 @@ def unit_perp(U, handedness=1.):
     return np.array((V_xyz[0], V_xyz[1]))
 
 def _null_tag_for(trip_id):
-    ll = trip_id.split("_")[1][0]
-    dd = trip_id.split(".")[-1][0]
-    null_string = ll + "_" + "_NULL_STOP_" + dd
+    trip = trip_descriptor(trip_id)
+    null_string = trip.line + "_" + "_NULL_STOP_" + trip.direction
     return null_string
 
 # take list of tuples with arbitrary nested lists following the same format
@@ -118,20 +148,29 @@ def _make_table(data):
     #S = "<div id='table_in_hover'><table><tbody>"
     #S = "<div id='table_in_hover' style='z-index:10'><table style={display:block; position:absolute; z-index:100; left:0px; right;0px;}>"# backgroundColor:'#4C4E52'; color:'rgba(255,255,255,1)}>"
     S = "<div id='table_in_hover'><table style='color:white'>"# backgroundColor:'#4C4E52'; color:'rgba(255,255,255,1)}>"
-    for row in data:
-        S = S + "<tr>"
-        for entry in row:
-            S = S + "<td>" + entry + "&nbsp&nbsp</td>"
-        S = S + "</tr>"#<br>"
-    S = S + "</table></div>"
-    #S = S + "</div>"
-    return S
+    # one join per row rather than a concatenation per cell
+    rows = ["<tr><td>" + "&nbsp&nbsp</td><td>".join(row) + "&nbsp&nbsp</td></tr>" if len(row) > 0 else "<tr></tr>" for row in data]
+    return S + "".join(rows) + "</table></div>"
+
+# train hover text has a fixed layout, so it is laid out once with _make_string/_make_table
+# and each refresh only substitutes the values
+TRAIN_HOVER_TEMPLATE = _make_string([("%(name)s", ["(unique id %(id)s)"]),\
+                                     ("Time", ["%(time)s"])]) +\
+                       _make_table([\
+                                    ["Approaching next stop:&nbsp&nbsp", "%(next_stop)s"],\
+                                    ["Scheduled arrival&nbsp&nbsp", "%(sched_arrival)s"],\
+                                    ["Behind schedule by&nbsp&nbsp", "%(t_late).1f mins"]]) +\
+                       _make_table([\
+                                    ["","actual","past performance"],\
+                                    ["Time elapsed for this trip", "%(duration_actual).1f mins", "%(T_trip_avg).1f mins"],\
+                                    ["Time elapsed on this segment", "%(segment_actual).1f mins", "%(segment_expected).1f mins"]])
 
 class systemManager():
-	def __init__(self, setLines, setDirections):
+	def __init__(self, setLines, setDirections, online=False, precompute=False):
                 self.selectLines = setLines
                 self.selectDirections = setDirections
                 self.routeData = routeData()
+                self._adjacency = self.routeData.adjacency()
                 self.stationLoc = stationLoc()
 
                 self.hover_fields = []#['name','time','location','schedule','data']
@@ -157,8 +196,9 @@ class systemManager():
                             stopDurations[ii] = {}
                         for DD in self.selectDirections:
                                 ii_DD = ii[:-1] + DD
-                                stopIntervals[ii] = stopIntervals[ii] + [{(ll,DD):frequencyAggregators[(ll,DD)].fetchSeries(ii_DD)}]
-                                stopDurations[ii][(ll,DD)] = self._durationAggregators[(ll,DD)].fetchSeries(ii_DD)
+                                stopIntervals[ii] = stopIntervals[ii] + [{(ll,DD):frequencyAggregators[(ll,DD)].fetchLazy(ii_DD)}]
+                                stopDurations[ii][(ll,DD)] = self._durationAggregators[(ll,DD)].fetchLazy(ii_DD)
+                self._frequencyAggregators = frequencyAggregators
                     #for DD in self.selectDirections:
                     #    frequencyAggregators[(ll,DD)].storeData()
                 stopList = set(stopList)
@@ -166,11 +206,14 @@ class systemManager():
                 for si in stopList:
                     self.stopSeries[si] = stopObj(si, self.stationLoc[si,:], self.plot_fields, stopIntervals[si], stopDurations[si])
 
-		self.drawStationData = pd.DataFrame(columns=self.plot_fields)
-		self.drawTrainData = pd.DataFrame(columns=self.plot_fields)
-                self.drawRouteData = pd.DataFrame(columns=['x','y','alpha','size','color'])
+		self.drawStationData = renderBuffer(self.plot_fields)
+		self.drawTrainData = renderBuffer(self.plot_fields)
+                routePlotData = OrderedDict()
 
                 self._allRoutes = {}
+                self._routeList = []
+                ## rows past len(self._routeList) are spare capacity
+                self._routeMatrix = np.zeros((256, 6))
                 self._segmentAggregators = {}
                 for ll in self.selectLines:
                     for dd in self.selectDirections:
@@ -182,9 +225,10 @@ class systemManager():
                                 rData = routeSlice.loc[ri,:]
                                 #print "instantiating route",ri,rData
 				#routeStats = agg.process_tuple(rData['origin'], rData['destination'])
-				routeStats = self._segmentAggregators[(ll,dd)].fetchSeries((rData['origin'], rData['destination']))
+				routeStats = self._segmentAggregators[(ll,dd)].fetchLazy((rData['origin'], rData['destination']))
                                 self._allRoutes[ri] = routeObj(ri, rData['origin'], rData['destination'], self.stationLoc, stats=routeStats)
-                                self.drawRouteData.loc[ri,:] = self._allRoutes[ri].plotData()
+                                self._indexRoute(self._allRoutes[ri])
+                                routePlotData[ri] = self._allRoutes[ri].plotData()
                                 targetStop = rData['destination']
                                 if "NULL" in targetStop:
                                     continue 
@@ -192,11 +236,32 @@ class systemManager():
                                     continue 
                                 else:
                                     targetStop = targetStop[:-1] + "N"
-                                    self.stopSeries[targetStop].associateRoute(ll,dd,self._allRoutes[ri].trainsOnRoute)
+                                    self.stopSeries[targetStop].associateRoute(ll,dd,self._allRoutes[ri].approaching)
+                self.drawRouteData = pd.DataFrame(routePlotData.values(), index=routePlotData.keys(),
+                                                  columns=['x','y','alpha','size','color'])
                 print "INITIALIZED ALL ROUTES",len(self._allRoutes)
 
+                ## online mode: completed segments and arrivals refresh the aggregator statistics
+                self.online = online
+                self._lastArrival = {}
+                if self.online:
+                        for key in self._segmentAggregators.keys():
+                                self._segmentAggregators[key].enableOnline()
+                                self._frequencyAggregators[key].enableOnline()
+                                self._durationAggregators[key].enableOnline()
+
+                ## statistics are fetched on first use; optionally warm them up off the main thread
+                self._precomputeThread = None
+                if precompute:
+                        lazy = [route.stats for route in self._allRoutes.values()]
+                        for stop in self.stopSeries:
+                                lazy += [intervalSet.values()[0] for intervalSet in stop.interval_list]
+                                lazy += stop.duration_dict.values()
+                        self._precomputeThread = precompute_series(lazy)
+
                 #self.activeTrains = {}
                 self.activeTrains = OrderedDict()
+                self.trainTable = trainTable()
 		#print "Stop Data Loaded",self.stopSeries.index
 
         def plot_boundaries(self):
@@ -210,47 +275,74 @@ class systemManager():
                 xmin = min(lons) - padding
                 xmax = max(lons) + 2*padding
                 print "active boundaries",xmin,xmax,ymin,ymax
-                sys_xmin, sys_ymin = _map_projection(sys_xmin, sys_ymin)
-                sys_xmax, sys_ymax = _map_projection(sys_xmax, sys_ymax)
+                (sys_xmin, sys_xmax), (sys_ymin, sys_ymax) = _map_projection(np.array((sys_xmin, sys_xmax)), np.array((sys_ymin, sys_ymax)))
                 print "system boundaries",sys_xmin, sys_xmax, sys_ymin, sys_ymax
 		return xmin, xmax, ymin, ymax
 
+        def _selectMask(self, trip_ids):
+                ## look the raw trip id values up in one pass; on a feed-sized batch the fixed cost of
+                ## pandas .str chains, Series.map or column assignment outweighs the lookups themselves
+                trips = [trip_descriptor(trip_id) for trip_id in trip_ids]
+                lines = np.array([trip.line for trip in trips])
+                directions = np.array([trip.direction for trip in trips])
+                return np.in1d(lines, self.selectLines) & np.in1d(directions, self.selectDirections), lines, directions
+
         def selectData(self, newDF):
-                newDF['line'] = newDF['trip_id'].map(lambda x: x.split("_")[1][0]) 
-                newDF['direction'] = newDF['trip_id'].map(lambda x: x.split(".")[-1][0]) 
-                newDF = newDF[newDF['line'].isin(self.selectLines)]
+                keep, lines, directions = self._selectMask(newDF['trip_id'].values)
+                newDF['line'] = lines
+                newDF['direction'] = directions
                 #newDF = newDF[newDF['stop'].isin(self.stopSeries.index)]
-                newDF = newDF[newDF['direction'].isin(self.selectDirections)]
-                return newDF
+                return newDF[keep]
 
         def streamUpdate(self, newDF):
-                newDF = self.selectData(newDF)
                 #print "culled stream data"
                 #print newDF[['timestamp', 'trip_id','stop','arrive']]
-                for i in newDF.index:
-                        self._updateTrain(newDF.loc[i, 'trip_id'],
-                                         newDF.loc[i, 'timestamp'],
-                                         newDF.loc[i,'stop'],
-                                         newDF.loc[i,'arrive'],
-					 newDF.loc[i,'depart'])
-                self._purgeStalled(newDF.loc[newDF.index[0],'timestamp'], 10.)
+                if len(newDF) == 0:
+                        return
+                keep = self._selectMask(newDF['trip_id'].values)[0]
+                if not keep.any():
+                        return
+                trip_ids = newDF['trip_id'].values[keep]
+                timestamps = newDF['timestamp'].values[keep]
+                next_stops = newDF['stop'].values[keep]
+                t_arrive = newDF['arrive'].values[keep]
+                t_depart = newDF['depart'].values[keep]
+                t_sched = np.maximum(t_arrive, t_depart)
+                ## rows are applied in feed order; a known trip still approaching the same stop only needs
+                ## its times refreshed, anything else (new trip, stop passed) takes the full path
+                for i in range(len(trip_ids)):
+                        train = self.activeTrains.get(trip_ids[i])
+                        if train is not None and next_stops[i] == train.attrib['next_stop']:
+                                train.update_trip(timestamps[i], next_stops[i], t_sched[i])
+                        else:
+                                self._updateTrain(trip_ids[i], timestamps[i], next_stops[i], t_arrive[i], t_depart[i])
+                self._purgeStalled(newDF['timestamp'].values.max(), 10.)
 
         def evolve(self, t_now, t_ref):
                 hour = time.localtime(t_now)[3]
-                for train in self.activeTrains.values():
+                trains = self.activeTrains.values()
+                n = len(trains)
+                slots = np.array([train.slot for train in trains], dtype=int)
+                coords = [None]*n
+                segment_duration = np.zeros(n)
+                trip_duration = np.zeros(n)
+                x, y, isLate, progressFraction = self._trainPositions(slots, t_now)
+                for i, train in enumerate(trains):
                         routeOrigin, routeDest = train.attrib['routeID']
 			train_id = train.attrib['id']
-                        coords, isLate, progressFraction = self._getRoute(train_id, (routeOrigin, routeDest)).trainPosition(train_id, t_now)
-                        segment_duration = self._getRoute(train_id, (routeOrigin, routeDest)).stats.get(hour).get("50%",0.)
-                        ll = train_id.split("_")[1][0]
-                        dd = train_id.split(".")[-1][0]
+                        coords[i] = (x[i], y[i])
+                        segment_duration[i] = self._getRoute(train_id, (routeOrigin, routeDest)).stats.get(hour).get("50%",0.)
                         stopRecastID = routeDest[:-1] + "N"
-                        trip_duration = self.stopSeries[stopRecastID].duration_dict.get((ll,dd),{}).get(hour,0)
-                        train.update_position(t_now, coords, isLate, progressFraction, segment_duration, trip_duration, self.plot_fields)
-                        self.drawTrainData.loc[train_id,:] = train.plotData()
-                for stop_id in self.stopSeries.index:
-                        self.stopSeries[stop_id].updateProgress(t_now, self.plot_fields)
-                        self.drawStationData.loc[stop_id,:] = self.stopSeries[stop_id].plotData()
+                        trip_duration[i] = self.stopSeries[stopRecastID].duration_dict.get(trip_descriptor(train_id).key,{}).get(hour,0)
+                ## numeric state of every train moves forward in one pass; hover text is still built per train
+                self.trainTable.advance(slots, t_now, isLate, progressFraction, segment_duration, trip_duration)
+                for i, train in enumerate(trains):
+                        train.render(t_now, coords[i], progressFraction[i], segment_duration[i], trip_duration[i], self.plot_fields)
+                self.drawTrainData.write([train.attrib['id'] for train in trains], [train.plotData() for train in trains])
+                stops = self.stopSeries.values
+                for stop in stops:
+                        stop.updateProgress(t_now, self.plot_fields)
+                self.drawStationData.write(self.stopSeries.index, [stop.plotData() for stop in stops])
 
                 # show segment patches where trains are running behind schedule
                 for route in self._allRoutes.values():
@@ -262,55 +354,119 @@ class systemManager():
                     #route.setPlotDataByDict([route.attrib['id']], {'x':[route.x_coords], 'y':[route.y_coords], 'alpha':[alpha]})
 
 	def drawSystem(self, timestring):
-		return self.drawStationData, self.drawTrainData, self.drawRouteData, self.plot_fields, self.hover_fields
+		return self.drawStationData.frame(), self.drawTrainData.frame(), self.drawRouteData, self.plot_fields, self.hover_fields
 	
         def _updateTrain(self, trip_id, timestamp, next_stop, t_arrive, t_depart):
 		t_arrive = max(t_arrive, t_depart)
 		if not self.activeTrains.get(trip_id):
                         prev_stop = self._lookupPrev(trip_id, next_stop)
-        		self.activeTrains[trip_id] = trainObj(trip_id, prev_stop, next_stop, timestamp)
-        		self._getRoute(trip_id, (prev_stop, next_stop)).addTrain(trip_id, timestamp, t_arrive)
+        		self.activeTrains[trip_id] = trainObj(trip_id, prev_stop, next_stop, timestamp, self.trainTable)
+        		self._placeTrain(trip_id, self._getRoute(trip_id, (prev_stop, next_stop)), timestamp, t_arrive)
 
+                t_segment_start = self.activeTrains[trip_id].attrib['t_segment_start']
 		require_route_update, old_route_tuple, new_route_tuple = \
                         self.activeTrains[trip_id].update_trip(timestamp, next_stop, t_arrive)
 
                 if require_route_update:
+                        if self.online:
+                                self._observeArrival(self.activeTrains[trip_id], old_route_tuple, t_segment_start, timestamp)
                         self._getRoute(trip_id, old_route_tuple).clearTrain(trip_id, timestamp)
-                        self._getRoute(trip_id, new_route_tuple).addTrain(trip_id, timestamp, t_arrive)
+                        self._placeTrain(trip_id, self._getRoute(trip_id, new_route_tuple), timestamp, t_arrive)
                         oldStop = new_route_tuple[1][:-1] + "N"
                         self.stopSeries[oldStop].updateRecord(trip_id, timestamp)
 
+        def _observeArrival(self, train, (origin, dest), t_segment_start, t_arrival):
+            ## the train has just passed dest; feed what it measured into the online aggregators
+            if "_STOP_" in dest:
+                return
+            ll, dd = trip_descriptor(train.attrib['id']).key
+            if (ll,dd) not in self._segmentAggregators:
+                return
+            # statistics are bucketed by the hour the trip started, as in the offline aggregators
+            hour = time.localtime(train.attrib['trip_origin'])[3]
+            # the first segment seen started when the train first appeared, not when it left origin
+            if train.attrib['stops_passed'] > 1 and "_STOP_" not in origin:
+                self._segmentAggregators[(ll,dd)].observe((origin, dest), hour, t_arrival - t_segment_start)
+            last_arrival = self._lastArrival.get((ll,dd,dest))
+            if last_arrival is not None and t_arrival > last_arrival:
+                self._frequencyAggregators[(ll,dd)].observe(dest, hour, t_arrival - last_arrival)
+            self._lastArrival[(ll,dd,dest)] = t_arrival
+            if train.attrib['seen_from_origin']:
+                self._durationAggregators[(ll,dd)].observe(dest, hour, t_arrival - train.attrib['t_first_stop'])
+
+        def _indexRoute(self, route):
+                ## one row of the route matrix per route: origin, direction vector and perpendicular offset
+                route.index = len(self._routeList)
+                self._routeList.append(route)
+                if route.index == len(self._routeMatrix):
+                        # doubled when full, as slotTable grows, so indexing n routes copies O(n) rows
+                        self._routeMatrix = np.concatenate((self._routeMatrix, np.zeros(self._routeMatrix.shape)))
+                self._routeMatrix[route.index] = route.kernelRow()
+
+        def _placeTrain(self, trip_id, route, timestamp, t_arrive):
+                route.addTrain(trip_id, timestamp, t_arrive)
+                t_start, t_route_arrive, isLate = route.trainsOnRoute[trip_id]
+                c = self.trainTable.columns
+                slot = self.activeTrains[trip_id].slot
+                c['route_index'][slot] = route.index
+                c['route_t_start'][slot] = t_start
+                c['route_t_arrive'][slot] = t_route_arrive
+                c['route_late'][slot] = isLate
+
+        def _trainPositions(self, slots, t_now):
+                """routeObj.trainPosition for many trains at once: coordinates, late flags and progress fractions."""
+                c = self.trainTable.columns
+                t_start = c['route_t_start'][slots]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                        progress = np.fmax(0., (t_now - t_start)/(c['route_t_arrive'][slots] - t_start))
+                overdue = progress > 0.95
+                progress[overdue] = 0.98
+                R = self._routeMatrix[c['route_index'][slots]]
+                x = R[:,0] + progress*R[:,2] + R[:,4]
+                y = R[:,1] + progress*R[:,3] + R[:,5]
+                # trains about to reach their stop are flagged late on the route too, as trainPosition does
+                for slot in slots[overdue & ~c['route_late'][slots]]:
+                        route = self._routeList[c['route_index'][slot]]
+                        trip_id = self.trainTable.ids[slot]
+                        route.trainsOnRoute[trip_id] = route.trainsOnRoute[trip_id][:2] + (True,)
+                        c['route_late'][slot] = True
+                return x, y, c['route_late'][slots].copy(), progress
+
         def _getRoute(self, train_id, (origin, dest)):
-            ll = train_id.split("_")[1][0]
-            dd = train_id.split(".")[-1][0]
             tag = origin + "_" + dest
             if not self._allRoutes.get(tag):
 	        print "getRoute invoked route constructor between stations",origin,dest
-                self._allRoutes[tag] = routeObj(tag, origin, dest, self.stationLoc, self._segmentAggregators[(ll,dd)].fetchSeries((origin, dest)))
+                self._allRoutes[tag] = routeObj(tag, origin, dest, self.stationLoc, self._segmentAggregators[trip_descriptor(train_id).key].fetchLazy((origin, dest)))
+                self._indexRoute(self._allRoutes[tag])
             return self._allRoutes[tag]
 
         def _lookupPrev(self, trip_id, next_stop):
-            result = self.routeData.data[self.routeData.data['destination']==next_stop]
-            if len(result) == 0:
+            ll, dd = trip_descriptor(trip_id).key
+            neighbours, any_line = self._adjacency
+            prev_stop = neighbours.get((ll, dd, next_stop), [None, None])[0]
+            if prev_stop is None:
+                prev_stop = any_line.get(next_stop)
+            if prev_stop is None:
                 #null_tag = _null_tag_for(trip_id)
                 print "LOOKUP_PREV FAILED",next_stop,"RETURNING THE DESTINATION"
                 return next_stop
-            return result['origin'].values[0]
+            return prev_stop
 
         def _purgeStalled(self, t_current, t_wait_mins):
-            for train_id in self.activeTrains.keys():
-                t_last_update = self.activeTrains[train_id].attrib['time_of_update']
-                if (t_current - t_last_update)/60. > t_wait_mins:
+            for train_id in self.trainTable.stalled(t_current, t_wait_mins):
+                    t_last_update = self.activeTrains[train_id].attrib['time_of_update']
                     routeID = self.activeTrains[train_id].attrib['routeID']
                     print nice_time(t_current), "Purging stalled train",train_id, "after", (t_current-t_last_update)/60.,"mins inactive on route",routeID
                     self._getRoute(train_id, routeID).clearTrain(train_id, t_current)
-                    self.activeTrains.pop(train_id)
-                    self.drawTrainData = self.drawTrainData.drop(train_id, axis=0)
+                    self.trainTable.release(self.activeTrains.pop(train_id).slot)
+                    self.drawTrainData.remove(train_id)
 
 class vizComponent():
 	def __init__(self):
 		self.storePlotData = []
 		self.attrib = {}
+		self._hoverKey = None
+		self._hoverString = ""
 	
 	def data(self):
 		return self.plotData.data()
@@ -338,11 +494,222 @@ class vizComponent():
         def plotData(self):
             return self.storePlotData
 
+        def hoverString(self, key, build, *args):
+            ## hover html is only rebuilt when the displayed (already formatted) values change;
+            ## at the plot refresh rate most ticks leave a stop's text as it was
+            if key != self._hoverKey:
+                self._hoverString = build(*args)
+                self._hoverKey = key
+            return self._hoverString
+
+## numpy columns with one row ("slot") per live object; released slots go on a free list and are reused
+class slotTable():
+        def __init__(self, dtypes, capacity=256):
+                self.capacity = 0
+                self.columns = {}
+                for field, dtype in dtypes.items():
+                        self.columns[field] = np.zeros(0, dtype=dtype)
+                self.ids = np.empty(0, dtype=object)
+                self.active = np.zeros(0, dtype=bool)
+                self.free = []
+                self._grow(capacity)
+
+        def _grow(self, capacity):
+                added = capacity - self.capacity
+                for field in self.columns.keys():
+                        self.columns[field] = np.concatenate((self.columns[field], np.zeros(added, dtype=self.columns[field].dtype)))
+                self.ids = np.concatenate((self.ids, np.empty(added, dtype=object)))
+                self.active = np.concatenate((self.active, np.zeros(added, dtype=bool)))
+                # pop() hands out the lowest free slot first
+                self.free = range(capacity - 1, self.capacity - 1, -1) + self.free
+                self.capacity = capacity
+
+        def allocate(self, object_id):
+                if len(self.free) == 0:
+                        self._grow(max(1, 2*self.capacity))
+                slot = self.free.pop()
+                for column in self.columns.values():
+                        column[slot] = None if column.dtype == object else 0
+                self.ids[slot] = object_id
+                self.active[slot] = True
+                return slot
+
+        def release(self, slot):
+                self.active[slot] = False
+                self.ids[slot] = None
+                self.free.append(slot)
+
+        def activeSlots(self):
+                return np.nonzero(self.active)[0]
+
+## struct-of-arrays store for the numeric state of every active train
+class trainTable(slotTable):
+        FLOAT_FIELDS = ['time_of_update', 'sched_arrival', 'trip_origin', 'last_stop_time', 't_late',
+                        'duration_actual', 'segment_actual', 'T_trip_composite', 't_segment_start',
+                        't_segment_stored', 'progress', 'late_factor', 'route_t_start', 'route_t_arrive']
+        BOOL_FIELDS = ['isLate', 'seen_from_origin', 'route_late']
+        INT_FIELDS = ['stops_passed', 'update_count', 'route_index']
+
+        def __init__(self, capacity=256):
+                dtypes = {}
+                for field in self.FLOAT_FIELDS:
+                        dtypes[field] = float
+                for field in self.BOOL_FIELDS:
+                        dtypes[field] = bool
+                for field in self.INT_FIELDS:
+                        dtypes[field] = int
+                slotTable.__init__(self, dtypes, capacity)
+                ## min-heap of (time_of_update, train id, slot), pushed by stamp(); entries are left in
+                ## place when a train is updated again or released and are dropped as they come off the top
+                self.expiry = []
+
+        def stamp(self, slot, timestamp):
+                self.columns['time_of_update'][slot] = timestamp
+                heapq.heappush(self.expiry, (timestamp, self.ids[slot], slot))
+
+        def stalled(self, t_current, t_wait_mins):
+                """ids of active trains not updated for more than t_wait_mins, in slot order"""
+                expired = {}
+                while len(self.expiry) > 0 and (t_current - self.expiry[0][0])/60. > t_wait_mins:
+                        t_update, train_id, slot = heapq.heappop(self.expiry)
+                        if self.active[slot] and self.ids[slot] == train_id and self.columns['time_of_update'][slot] == t_update:
+                                expired[slot] = train_id
+                return [expired[slot] for slot in sorted(expired.keys())]
+
+        def advance(self, slots, timestamp, isLate, progressFraction, T_segment_avg, T_trip_avg):
+                """Per-tick update of the given trains in one pass; the array form of trainObj.update_position."""
+                c = self.columns
+                c['segment_actual'][slots] = (timestamp - c['t_segment_start'][slots])/60.
+                c['t_segment_stored'][slots] = T_segment_avg/60.
+                duration = c['duration_actual'][slots]
+                with np.errstate(divide='ignore', invalid='ignore'):
+                        late_factor = np.maximum(0., duration - T_trip_avg)/duration
+                c['late_factor'][slots] = np.where(T_trip_avg == 0, 0., late_factor)
+                c['update_count'][slots] += 1
+                c['isLate'][slots] = isLate
+                c['progress'][slots] = progressFraction
+                c['t_late'][slots] = np.maximum(0., (timestamp - c['sched_arrival'][slots])/60.)
+
+## dict-like view of one train: fields with a trainTable column read and write the table, the rest a plain dict
+class trainAttrib():
+        def __init__(self, table, slot):
+                self._table = table
+                self._slot = slot
+                self._other = {}
+
+        def __getitem__(self, key):
+                column = self._table.columns.get(key)
+                if column is None:
+                        return self._other[key]
+                return column[self._slot].item()
+
+        def __setitem__(self, key, value):
+                column = self._table.columns.get(key)
+                if column is None:
+                        self._other[key] = value
+                else:
+                        column[self._slot] = value
+
+        def __contains__(self, key):
+                return key in self._table.columns or key in self._other
+
+        def get(self, key, default=None):
+                if key in self:
+                        return self[key]
+                return default
+
+        def keys(self):
+                return self._table.columns.keys() + self._other.keys()
+
+        def items(self):
+                return [(key, self[key]) for key in self.keys()]
+
+## plot data for drawSystem: each key (train or stop id) keeps one row while it is displayed and a
+## tick writes all rows in place. Rows are kept packed at the top of a preallocated DataFrame, so
+## frame() is a slice of it rather than a new frame built per tick
+class renderBuffer():
+        NUMERIC_FIELDS = ['x', 'y', 'size', 'alpha']
+
+        def __init__(self, fields, capacity=256):
+                self.fields = fields
+                self.slots = {}
+                self.size = 0
+                self.capacity = 0
+                self._frame = None
+                self._grow(capacity)
+
+        def _grow(self, capacity):
+                ## the frame owns the storage; columns holds a writable view of each of its columns
+                data = OrderedDict()
+                for field in self.fields:
+                        if field in self.NUMERIC_FIELDS:
+                                column = np.zeros(capacity)
+                        else:
+                                column = np.empty(capacity, dtype=object)
+                        if self._frame is not None:
+                                column[:self.size] = self.columns[field][:self.size]
+                        data[field] = column
+                ids = np.empty(capacity, dtype=object)
+                if self._frame is not None:
+                        ids[:self.size] = self.ids[:self.size]
+                self.ids = ids
+                self._frame = pd.DataFrame(data, columns=self.fields)
+                self.columns = dict([(field, self._frame[field].values) for field in self.fields])
+                self.capacity = capacity
+
+        def write(self, keys, rows):
+                slots = np.empty(len(keys), dtype=int)
+                for i, key in enumerate(keys):
+                        slot = self.slots.get(key)
+                        if slot is None:
+                                if self.size == self.capacity:
+                                        self._grow(2*self.capacity)
+                                slot = self.size
+                                self.size += 1
+                                self.slots[key] = slot
+                                self.ids[slot] = key
+                        slots[i] = slot
+                for j, field in enumerate(self.fields):
+                        column = self.columns[field]
+                        for slot, row in zip(slots, rows):
+                                column[slot] = row[j]
+
+        def remove(self, key):
+                ## the last row moves into the gap, keeping rows packed
+                slot = self.slots.pop(key, None)
+                if slot is None:
+                        return
+                last = self.size - 1
+                if slot != last:
+                        moved = self.ids[last]
+                        for column in self.columns.values():
+                                column[slot] = column[last]
+                        self.ids[slot] = moved
+                        self.slots[moved] = slot
+                for column in self.columns.values():
+                        if column.dtype == object:
+                                column[last] = None
+                self.ids[last] = None
+                self.size = last
+
+        def frame(self):
+                """The displayed rows, indexed by key. Column values are a view that later writes change;
+                the index is a copy, so a retained frame keeps its labels."""
+                view = self._frame.iloc[:self.size]
+                # the labels are copied: self.ids is rewritten in place by later writes and removes
+                view.index = pd.Index(self.ids[:self.size].copy())
+                return view
+
 class trainObj(vizComponent):
-	def __init__(self, train_id, prev_stop, next_stop, timestamp):
+	def __init__(self, train_id, prev_stop, next_stop, timestamp, table=None):
 		vizComponent.__init__(self)
+                if table is None:
+                        table = trainTable(1)
+                self.table = table
+                self.slot = table.allocate(train_id)
+                self.attrib = trainAttrib(table, self.slot)
 		self.attrib['id'] = train_id
-		self.attrib['time_of_update'] = timestamp
+		self.table.stamp(self.slot, timestamp)
                 null_tag = _null_tag_for(train_id)
                 self.attrib['next_stop'] = next_stop 
                 self.attrib['prev_stop'] = prev_stop 
@@ -358,13 +725,15 @@ class trainObj(vizComponent):
 		self.attrib['T_trip_composite'] = 0.
 		self.attrib['t_segment_start'] = timestamp
 		self.attrib['t_segment_stored'] = 0.
+                self.attrib['stops_passed'] = 0
+                self.attrib['seen_from_origin'] = "NULL" in prev_stop
+                self.attrib['t_first_stop'] = None
                 self.attrib['status'] = "normal"
-		self.update_count = 0
 
 	def update_trip(self, time_of_update, next_stop, t_arrive):
                 if self.attrib['trip_origin'] > self.attrib['time_of_update']:
                     self.attrib['status'] = "inactive"
-		self.attrib['time_of_update'] = time_of_update
+		self.table.stamp(self.slot, time_of_update)
 		self.attrib['sched_arrival'] = t_arrive
 		self.attrib['duration_actual'] = (time_of_update - self.attrib['trip_origin'])/60.
 
@@ -375,6 +744,9 @@ class trainObj(vizComponent):
                 if next_stop != self.attrib['next_stop']:
                         newStop = True
                         self.attrib['last_stop_time'] = time_of_update
+                        self.attrib['stops_passed'] += 1
+                        if self.attrib['t_first_stop'] is None:
+                                self.attrib['t_first_stop'] = time_of_update
                         self.attrib['prev_stop'] = self.attrib['next_stop']
 		        self.attrib['next_stop'] = next_stop
                         self.attrib['routeID'] = (self.attrib['prev_stop'], self.attrib['next_stop'])
@@ -391,16 +763,12 @@ class trainObj(vizComponent):
                 return newStop, old_route_tuple, self.attrib['routeID']
 
         def update_position(self, timestamp, coords, isLate, progressFraction, T_segment_avg, T_trip_avg, fields):
-                self.attrib['segment_actual'] = (timestamp - self.attrib['t_segment_start'])/60.
-                self.attrib['t_segment_stored'] = T_segment_avg/60.
-                if T_trip_avg == 0:
-                    lateFactor = 0.
-                else:
-                    t_trip_late = self.attrib['duration_actual'] - T_trip_avg
-                    lateFactor = max(0.,t_trip_late)/self.attrib['duration_actual']
-                self.update_count += 1
-                self.attrib['isLate'] = isLate 
-		self.attrib['t_late'] = max(0.,(timestamp - self.attrib['sched_arrival'])/60.)
+                self.table.advance([self.slot], timestamp, isLate, progressFraction, T_segment_avg, T_trip_avg)
+                self.render(timestamp, coords, progressFraction, T_segment_avg, T_trip_avg, fields)
+
+        def render(self, timestamp, coords, progressFraction, T_segment_avg, T_trip_avg, fields):
+                ## plot data from the state trainTable.advance has just updated
+                lateFactor = self.table.columns['late_factor'][self.slot]
                 markerColor = _color_for_status(lateFactor)
                 markerAlpha = 1.0
                 if self.attrib['status'] == "inactive":
@@ -411,21 +779,20 @@ class trainObj(vizComponent):
                                  markerColor,\
                                  float(12),\
                                  markerAlpha,\
-                                _make_string([(self['name'],["(unique id " + self['id'] + ")"]),\
-                                              ("Time", [nice_time(timestamp, military=False)])]) +\
-                                    _make_table([\
-                                                 ["Approaching next stop:&nbsp&nbsp", station_names[self['next_stop']]],\
-                                                 ["Scheduled arrival&nbsp&nbsp", nice_time(self.attrib['sched_arrival'], military=False)],\
-                                                 ["Behind schedule by&nbsp&nbsp", "%.1f" % float(self.attrib['t_late']) + " mins"]]) +\
-                                    _make_table([\
-                                                 ["","actual","past performance"],\
-                                                 ["Time elapsed for this trip", "%.1f" % float(self.attrib['duration_actual']) + " mins", "%.1f" % float(T_trip_avg) + " mins"],\
-                                                 ["Time elapsed on this segment", "%.1f" % float(self.attrib['segment_actual']) + " mins", "%.1f" % float(progressFraction*T_segment_avg/60.) + " mins"]])
-                                             ])
+                                 TRAIN_HOVER_TEMPLATE % {'name':self['name'],
+                                                         'id':self['id'],
+                                                         'time':nice_time(timestamp, military=False),
+                                                         'next_stop':station_names[self['next_stop']],
+                                                         'sched_arrival':nice_time(self.attrib['sched_arrival'], military=False),
+                                                         't_late':float(self.attrib['t_late']),
+                                                         'duration_actual':float(self.attrib['duration_actual']),
+                                                         'T_trip_avg':float(T_trip_avg),
+                                                         'segment_actual':float(self.attrib['segment_actual']),
+                                                         'segment_expected':float(progressFraction*T_segment_avg/60.)}])
 
         def _calc_trip_origin(self, current_time):
 		t_ref = get_TOD_reference(current_time)
-		minutes100 = float(self.attrib['id'].split("_")[0])
+		minutes100 = trip_descriptor(self.attrib['id']).origin
                 t_origin = int(0.6*minutes100 + t_ref)
                 if current_time - t_origin < -3600: #some trips are reported before departure so negative times will manifest
                         return t_origin - 86400 #subtract number of seconds in a day to handle midnight crossings
@@ -433,8 +800,7 @@ class trainObj(vizComponent):
                         return t_origin
 
         def _make_train_name(self):
-                ll = self['id'].split("_")[1][0]
-                dd = self['id'].split(".")[-1][0]
+                ll, dd = trip_descriptor(self['id']).key
                 name_string = ll + " Train " + {'N':"Uptown", 'S':"Downtown"}[dd]
                 return name_string
 
@@ -442,7 +808,7 @@ class stopObj(vizComponent):
 	def __init__(self, stop_id, stopData, fields, interval_list, duration_dict):
 		vizComponent.__init__(self)
 		self.attrib['id'] = stop_id
-                proj_x, proj_y = _map_projection(float(stopData['lon']), float(stopData['lat']))
+                proj_x, proj_y = _station_projection(stop_id)
 		self.attrib['lon'] = proj_x
 		self.attrib['lat'] = proj_y
 		self.attrib['name'] = np.array(stopData['name'])
@@ -453,13 +819,12 @@ class stopObj(vizComponent):
                 self.interval_list = interval_list
                 self.duration_dict= duration_dict
 
-        def associateRoute(self, ll, dd, trainsOnRouteDict):
-            self.routes[(ll,dd)] = trainsOnRouteDict
+        def associateRoute(self, ll, dd, approaching):
+            self.routes[(ll,dd)] = approaching
             self.lastStop[(ll,dd)] = [time.time()]
 
         def updateRecord(self, trip_id, timestamp):
-            ll = trip_id.split("_")[1][0]
-            dd = trip_id.split(".")[-1][0]
+            ll, dd = trip_descriptor(trip_id).key
             if not self.lastStop.get((ll,dd)):
                 print self['id'],trip_id,"encountered unassociated route",ll,dd
                 self.lastStop[(ll,dd)] = [timestamp]
@@ -471,26 +836,31 @@ class stopObj(vizComponent):
 
         def updateProgress(self, timestamp, fields):
                 t_late_approaching, trains_approaching_string = self._listApproaching(timestamp)
+                hoverValues = (nice_time(time.time(), military=False),
+                               tuple(trains_approaching_string),
+                               tuple([tuple(row) for row in self._listStopData(timestamp)]))
                 self.setPlotData(fields=fields,\
                                  data=[float(self.attrib['lon']),\
                                        float(self.attrib['lat']),\
                                        _stop_color_for_status(t_late_approaching/60.),\
                                        float(7),\
                                        float(1.0),\
-                                       _make_string([("Station", [str(self['name'])]),\
-                                                     ("Time", [nice_time(time.time(), military=False)]),\
-                                                     ("Trains approaching", trains_approaching_string),\
-                                                     ("Arrival Stats", [""])]) +\
-                                       _make_table(self._listStopData(timestamp))])
+                                       self.hoverString(hoverValues, self._hoverHTML, *hoverValues)])
+
+        def _hoverHTML(self, timeString, trains_approaching_string, stopData):
+                return _make_string([("Station", [str(self['name'])]),\
+                                     ("Time", [timeString]),\
+                                     ("Trains approaching", list(trains_approaching_string)),\
+                                     ("Arrival Stats", [""])]) +\
+                        _make_table(stopData)
 
         def _listApproaching(self, t_now):
             strings = []
             t_late = 0.
             for (ll,dd) in self.routes.keys():
-                trainsDict = self.routes[(ll,dd)]
-                listTrains = "; ".join([nice_time(t[1], military=False) for t in trainsDict.values()])
-                for t_data in trainsDict.values():
-                    t_late = t_late + max(0., t_now-t_data[1])
+                approaching = self.routes[(ll,dd)]
+                listTrains = approaching.dueString()
+                t_late = t_late + approaching.lateness(t_now)
                 direction_tag = {"N":"Uptown","S":"Downtown"}
                 if len(listTrains) > 0:
                     strings.append((str(ll) + " " + direction_tag[dd] + " due", listTrains))
@@ -527,6 +897,40 @@ class stopObj(vizComponent):
                     strings.append(["&nbsp&nbsp", str(ll) + " " + direction_tag[dd], self._formatString(t_waiting), self._formatString(self.currentFreq.get((ll,dd))), self._formatString(freq)])
             return strings
 
+## trains heading for a route's destination stop, in order of expected arrival;
+## kept current by routeObj.addTrain/clearTrain so a stop refresh does not rescan the route
+class approachList():
+        def __init__(self):
+                self.arrivals = []
+                self.t_arrive = {}
+                self._dueString = None
+
+        def add(self, trip_id, t_arrive):
+                self.remove(trip_id)
+                bisect.insort(self.arrivals, (t_arrive, trip_id))
+                self.t_arrive[trip_id] = t_arrive
+                self._dueString = None
+
+        def remove(self, trip_id):
+                if trip_id in self.t_arrive:
+                        self.arrivals.remove((self.t_arrive.pop(trip_id), trip_id))
+                        self._dueString = None
+
+        def dueString(self):
+                ## formatted once per change rather than on every refresh
+                if self._dueString is None:
+                        self._dueString = "; ".join([nice_time(t_arrive, military=False) for t_arrive, trip_id in self.arrivals])
+                return self._dueString
+
+        def lateness(self, t_now):
+                """seconds by which the trains due before t_now are overdue, summed"""
+                t_late = 0.
+                for t_arrive, trip_id in self.arrivals:
+                        if t_arrive >= t_now:
+                                break
+                        t_late = t_late + (t_now - t_arrive)
+                return t_late
+
 class routeObj(vizComponent):
 	def __init__(self, route_id, origin_id, destination_id, stationLoc, travel_time=1.0, stats=NULL_STATS):
 		vizComponent.__init__(self)
@@ -536,10 +940,8 @@ class routeObj(vizComponent):
                 self.attrib['travel_time'] = travel_time 
 		self.stats = stats
                 
-                origin_lon, origin_lat = stationLoc[self.attrib['origin_stop'],'lon'], stationLoc[self.attrib['origin_stop'], 'lat']
-                dest_lon, dest_lat = stationLoc[self.attrib['dest_stop'],'lon'], stationLoc[self.attrib['dest_stop'], 'lat']
-                origin_x, origin_y = _map_projection(origin_lon, origin_lat)
-                dest_x, dest_y = _map_projection(dest_lon, dest_lat)
+                origin_x, origin_y = _station_projection(self.attrib['origin_stop'])
+                dest_x, dest_y = _station_projection(self.attrib['dest_stop'])
                 self.origin_coord = np.array((origin_x, origin_y))
                 self.dest_coord = np.array((dest_x, dest_y))
                 #print "ROUTE",self['id'], self.origin_coord, self.dest_coord
@@ -547,11 +949,19 @@ class routeObj(vizComponent):
                 self.y_coords = np.array((origin_y, dest_y))
                 #print "ROUTE",self['id'], self.x_coords, self.y_coords
                 self.trainsOnRoute = OrderedDict()
+                self.approaching = approachList()
                 infoString = "route"
                 ## todo this should be a dynamic update based on system time
                 hour = time.localtime(time.time())[3]
                 self.setPlotData(fields=['x','y','alpha','size','color'], data=[self.x_coords, self.y_coords, 1., 1., "#FFCC00"])
 
+        def kernelRow(self):
+                ## origin, direction vector and perpendicular offset, laid out for systemManager._trainPositions
+                U = self.dest_coord - self.origin_coord
+                if np.dot(U,U) == 0.:
+                        return np.array((self.origin_coord[0], self.origin_coord[1], 0., 0., 0., 0.))
+                return np.concatenate((self.origin_coord, U, 350.*unit_perp(U)))
+
         def trainPosition(self, trip_id, timestamp, dir_shift=True):
                 t_start, t_arrive, isLate = self.trainsOnRoute[trip_id]
                 progress_fraction = max(0., float(timestamp - t_start)/(t_arrive - t_start))
@@ -565,7 +975,7 @@ class routeObj(vizComponent):
                     return self.origin_coord, isLate, progress_fraction
 		V = np.array((0., 0.))
 		if dir_shift:
-		    dd = trip_id.split(".")[-1][0]
+		    dd = trip_descriptor(trip_id).direction
 		    sign = 1.
 		    if dd=="S":
                         sign = -1.
@@ -580,9 +990,11 @@ class routeObj(vizComponent):
 			t_arrive = t_start + self.stats.get(hour,0.).get('50%',0.)
 			isLate = True
                 self.trainsOnRoute[trip_id] = (t_start, t_arrive, isLate)
+                self.approaching.add(trip_id, t_arrive)
 
         def clearTrain(self, trip_id, timestamp):
                 self.trainsOnRoute.pop(trip_id)
+                self.approaching.remove(trip_id)
 	
 if __name__=="__main__":
         print "dataEngine::__main__"
@@ -1,12 +1,18 @@
 import numpy as np
 import pandas as pd
+import os
+import resource
+import sys
+import threading
 import time
+from collections import OrderedDict
 
 from dataEngine import systemManager
 from streamManagers import streamSimulator, liveStreamReader
 from plotInterfaces import bokehPlotInterface, dummyPlotInterface
 
 from collect import nice_time
+from sketches import streamingStats
 
 class plotManager():
     def __init__(self, systemManager, streamManager, plotDevice):
@@ -17,9 +23,19 @@ class plotManager():
 
         self.updateDataInterval = 30.
         self.refreshPlotInterval = 5.
-        self.acceleration = 1.
+        self.acceleration = streamManager.acceleration
         self.Tend = 3600.*24
 
+        ## the feed thread applies updates to the system manager and the render thread evolves and
+        ## draws it; each holds this lock only for its own step, and a tick plots a frame it copied out
+        self._systemLock = threading.Lock()
+        self._updated = threading.Event()
+        self._stop = threading.Event()
+        ## seconds; feed_lag is stream time minus the feed's own timestamp, render_jitter how late a refresh started
+        self.metrics = OrderedDict([(name, streamingStats()) for name in
+                                    ['feed_lag', 'feed_read', 'feed_apply', 'render_jitter', 'render_time']])
+        self.skippedRefreshes = 0
+
     def setLifetime(self, Tend):
         self.Tend = Tend
         print "plotManager::::::::::(times in secs)"
@@ -27,44 +43,169 @@ class plotManager():
         print "plot refresh interval",self.refreshPlotInterval
         print "data update interval",self.updateDataInterval
 
+    def streamTime(self):
+        ## stream clock: starts at T0 and runs acceleration times faster than the wall clock
+        return self.T0 + self.acceleration*(time.time() - self._wall0)
+
+    def report(self):
+        stats = pd.DataFrame(OrderedDict([(name, stat.describe()) for name, stat in self.metrics.items()]))
+        print "plotManager metrics (secs);", self.skippedRefreshes, "refreshes skipped"
+        print stats
+        return stats
+
+    def _wait_until(self, deadline):
+        ## True if stopped while waiting
+        return self._stop.wait(max(0., deadline - time.time())) or self._stop.is_set()
+
+    def _feed(self):
+        ## feed thread: blocking stream reads on the update schedule, each applied to the system manager here.
+        ## Windows follow on from each other in stream time, so a slow read delays but does not skip data
+        T = self.T0
+        while not self._stop.is_set():
+            t0 = time.time()
+            t_update, updateDF = self.streamMgr.read(T, T+self.updateDataInterval)
+            if self._stop.is_set():
+                return
+            self.metrics['feed_read'].add(time.time() - t0)
+            t_lag = self.streamTime() - t_update
+            self.metrics['feed_lag'].add(t_lag)
+            t0 = time.time()
+            with self._systemLock:
+                self._applyUpdates([(T, t_update, updateDF)])
+            self.metrics['feed_apply'].add(time.time() - t0)
+            self._updated.set()
+            print nice_time(t_update), nice_time(T), "lag between current wall-clock time and real-time feed update:","%.1f" % t_lag, "seconds"
+            T = T + self.updateDataInterval
+            if self._wait_until(self._wall0 + (T - self.T0)/self.acceleration):
+                return
+
+    def _applyUpdates(self, updates):
+        records = 0
+        for T, t_update, updateDF in updates:
+            self.T_last_update, self.t_update = T, t_update
+            if len(updateDF)>0:
+                self.mgr.streamUpdate(updateDF)
+                records += len(updateDF)
+            else:
+                print "Skipped processing DF of length ZERO"
+        return records
+
+    def _frames(self, T):
+        ## evolve the system to T and copy out what the plot device needs
+        t_plot = self.t_update + T - self.T_last_update
+        self.mgr.evolve(t_plot, self.t_update)
+        stationData, trainData, routeData, fields, hoverFields = self.mgr.drawSystem(t_plot)
+        scatterData = pd.concat([stationData, trainData], axis=0)
+        return t_plot, scatterData, routeData, fields, hoverFields
+
+    def _draw(self, T):
+        t_plot, scatterData, routeData, fields, hoverFields = self._frames(T)
+        self.plotMgr.plot(scatterData, routeData, fields, hoverFields, t_plot)
+
+    def _render(self, scheduled):
+        self.metrics['render_jitter'].add(time.time() - scheduled)
+        t0 = time.time()
+        with self._systemLock:
+            t_plot, scatterData, routeData, fields, hoverFields = self._frames(self.streamTime())
+        # scatterData is this tick's own copy, so the feed thread can apply the next update while it is plotted
+        self.plotMgr.plot(scatterData, routeData, fields, hoverFields, t_plot)
+        self.metrics['render_time'].add(time.time() - t0)
+
     def run(self, use_T0=None):
-        self.T = time.time()
+        """Feed reads and system updates run on their own thread; evolving and plotting run on this one."""
+        self._wall0 = time.time()
+        self.T0 = self._wall0
         if use_T0:
-                self.T = use_T0
-        self.Tend = self.T + self.Tend
-	T_last_update = 0.
-	T_last_plot = 0.
-	initPlot = False
-
-        while self.T < self.Tend:
-	    if not initPlot:
-	        self.plotMgr.init_area(self.mgr.plot_boundaries())
-		initPlot = True
-
-	    if self.T - T_last_update > self.updateDataInterval:
-		T_last_update = self.T
-            	t_update, updateDF = self.streamMgr.read(self.T, self.T+self.updateDataInterval)
-                if len(updateDF)>0:
-            	        self.mgr.streamUpdate(updateDF)
-                else:
-                        print "Skipped processing DF of length ZERO"
-	    	t_lag = time.time() - t_update
-                print nice_time(t_update), nice_time(self.T), "lag between current wall-clock time and real-time feed update:","%.1f" % t_lag, "seconds"
-
-            self.T = time.time()
-            if self.T - T_last_plot > self.refreshPlotInterval:
-		t_plot = t_update + self.T - T_last_update
-                self.mgr.evolve(t_plot, t_update)
-                stationData, trainData, routeData, fields, hoverFields = self.mgr.drawSystem(t_plot)
-		scatterData = pd.concat([stationData, trainData], axis=0)
-                self.plotMgr.plot(scatterData, routeData, fields, hoverFields, t_plot)
-		T_last_plot = self.T
-
-	    #time.sleep((1./self.acceleration)*self.refreshPlotInterval)
-            self.T = time.time()#t_plot + self.refreshPlotInterval
+                self.T0 = use_T0
+        self.Tend = self.T0 + self.Tend
+        self._stop.clear()
+        self._updated.clear()
+        self.plotMgr.init_area(self.mgr.plot_boundaries())
+
+        feeder = threading.Thread(target=self._feed, name="plotManager feed")
+        feeder.daemon = True
+        feeder.start()
+        try:
+            # nothing to draw before the first update
+            while not self._updated.wait(1.) and feeder.is_alive():
+                pass
+            scheduled = time.time()
+            while self.streamTime() < self.Tend and feeder.is_alive():
+                self._render(scheduled)
+                scheduled = scheduled + self.refreshPlotInterval
+                if scheduled < time.time():
+                    # refreshes that could not start on time are dropped rather than run back to back
+                    missed = int((time.time() - scheduled)/self.refreshPlotInterval) + 1
+                    self.skippedRefreshes += missed
+                    scheduled = scheduled + missed*self.refreshPlotInterval
+                if self._wait_until(scheduled):
+                    break
+        finally:
+            self.stop()
+            # a read blocked on the network is left to finish on its own (the thread is a daemon)
+            feeder.join(self.updateDataInterval)
+        return self.report()
+
+    def stop(self):
+        self._stop.set()
+        self.streamMgr.stop()
+
+    def replay(self, use_T0=None, quiet=True):
+        """Run the recorded stream through the system manager and plot device on a virtual clock.
+
+        Reads and refreshes follow the schedule run() keeps at acceleration 1 (a read every
+        updateDataInterval, a refresh every refreshPlotInterval of stream time), but one after
+        the other on this thread with no waiting, so the same recording always does the same work.
+        Returns throughput, per-tick latency percentiles (secs; a tick is a refresh plus any read
+        due before it) and peak memory. quiet silences the engine's and plot device's prints.
+        """
+        T0 = use_T0 if use_T0 else self.streamMgr.T0
+        T_end = T0 + self.Tend
+        self.plotMgr.init_area(self.mgr.plot_boundaries())
+        T = T0
+        T_next_update = T0
+        records = 0
+        ticks = []
+        stdout = sys.stdout
+        if quiet:
+            sys.stdout = open(os.devnull, 'w')
+        t_start = time.time()
+        try:
+            while T < T_end:
+                t0 = time.time()
+                if T >= T_next_update:
+                    t_update, updateDF = self.streamMgr.read(T, T+self.updateDataInterval)
+                    records += self._applyUpdates([(T, t_update, updateDF)])
+                    T_next_update = T_next_update + self.updateDataInterval
+                self._draw(T)
+                ticks.append(time.time() - t0)
+                T = T + self.refreshPlotInterval
+        finally:
+            if quiet:
+                sys.stdout.close()
+                sys.stdout = stdout
+        elapsed = time.time() - t_start
+        ticks = np.array(ticks)
+        result = pd.Series(OrderedDict([
+                ('stream_secs', T - T0),
+                ('wall_secs', elapsed),
+                ('speedup', (T - T0)/elapsed),
+                ('events', records),
+                ('events_per_sec', records/elapsed),
+                ('ticks', len(ticks)),
+                ('tick_p50', np.percentile(ticks, 50)),
+                ('tick_p90', np.percentile(ticks, 90)),
+                ('tick_p99', np.percentile(ticks, 99)),
+                ('tick_max', ticks.max()),
+                # ru_maxrss is in kilobytes on Linux
+                ('maxrss_mb', resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.),
+                ('active_trains', len(self.mgr.activeTrains))]))
+        print "plotManager replay"
+        print result
+        return result
 
 if __name__ == "__main__":
-    mgr = systemManager(setLines=['1','2','3','4','5','6'], setDirections=['N','S'])
+    mgr = systemManager(setLines=['1','2','3','4','5','6'], setDirections=['N','S'], precompute=True)
     liveStream = liveStreamReader()      
     plotDevice= bokehPlotInterface()
     #plotDevice= dummyPlotInterface()
@@ -74,10 +215,10 @@ if __name__ == "__main__":
 
     ## simulation
     #mgr = systemManager()
-    #stream = streamSimulator("trip_data_test.csv")
+    #stream = streamSimulator("trip_data_test.csv", acceleration=60.)
     #plotDevice= bokehPlotInterface()
     #T0, Tfinal = stream.T0, stream.Tfinal
 
     #boss = plotManager(mgr, stream, plotDevice)
-    #boss.setLifetime(Tfinal)
+    #boss.setLifetime(Tfinal - T0)
     #boss.run(use_T0=T0)
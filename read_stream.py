@@ -1,16 +1,76 @@
 import gtfs_realtime_pb2
 import urllib2
+import urlparse
 import httplib
 import google.protobuf.message
+import random
+import socket
 import sys
+import time
 
 # MTA Feed API Key
 STREAM_URL = """http://datamine.mta.info/mta_esi.php?key="""
 FEED_ID = """&feed_id=1"""
 FEED_ID_2 = """&feed_id=2"""
 # you need to obtain an API key from the MTA website and place it in this file in your local directory
-with open("my_api_key",'r') as f:
-    API_KEY = f.readline()[:-1]
+try:
+    with open("my_api_key",'r') as f:
+        API_KEY = f.readline()[:-1]
+except IOError:
+    # decoding recorded feeds does not need a key; fetching does
+    print "read_stream: no my_api_key file found; live feed requests will fail"
+    API_KEY = ""
+
+def backoff_delay(failures, base=1., cap=60.):
+    """Seconds to wait after the given number of consecutive failed requests:
+    exponential in failures, capped, and jittered so that retries from several clients spread out."""
+    return random.uniform(0.5, 1.)*min(cap, base*2**(failures - 1))
+
+class feedConnection():
+    """Keep-alive HTTP connection for one feed id; fetch() returns the parsed FeedMessage
+    and raises on any network, HTTP or decode error."""
+    def __init__(self, feed_id, url=None, timeout=10.):
+        if url is None:
+            url = STREAM_URL + API_KEY
+        parts = urlparse.urlsplit(url)
+        self.feed_id = feed_id
+        self.host = parts.netloc
+        self.path = parts.path + "?" + parts.query + "&feed_id=" + str(feed_id)
+        self.timeout = timeout
+        self.connection = None
+        self.requests = 0
+
+    def _request(self):
+        if self.connection is None:
+            self.connection = httplib.HTTPConnection(self.host, timeout=self.timeout)
+        self.connection.request("GET", self.path)
+        response = self.connection.getresponse()
+        body = response.read()
+        if response.will_close:
+            self.close()
+        return response.status, body
+
+    def fetch(self):
+        reused = self.connection is not None
+        self.requests += 1
+        try:
+            status, body = self._request()
+        except (httplib.HTTPException, socket.error):
+            self.close()
+            if not reused:
+                raise
+            # the server may have dropped the idle connection; retry once on a new one
+            status, body = self._request()
+        if status != 200:
+            raise IOError("feed_id " + str(self.feed_id) + " returned HTTP status " + str(status))
+        nyct_feed = gtfs_realtime_pb2.FeedMessage()
+        nyct_feed.ParseFromString(body)
+        return nyct_feed
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
 
 def readMTADataStream(use_feed_id=FEED_ID):
     try:
@@ -51,7 +111,6 @@ def processMTAData(nyct_feed, filename):
 	print "dump complete",count
 
 if __name__ == "__main__":
-    import time
     max_time = 36000000
     local_time = 0
     wait_time = 30
@@ -62,6 +121,8 @@ if __name__ == "__main__":
         while not nyct_feed:
             attempts += 1
             nyct_feed = readMTADataStream(use_feed_id=FEED_ID)
+            if not nyct_feed:
+                time.sleep(backoff_delay(attempts))
         print "(read successful",attempts,")",
         t = time.localtime()
         filename = "mta_data_v2." + str(t[0]) + "." + str(t[1]) + "." + str(t[2]) + ".csv"
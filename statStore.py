@@ -0,0 +1,164 @@
+import glob
+import json
+import os
+import struct
+import numpy as np
+import pandas as pd
+
+## Compact on-disk store for the per-hour statistics the aggregators compute.
+##
+## layout:  8 byte magic | uint32 schema version | uint32 header length | json header | padding
+##          | float64 array shaped [token, hour, stat]
+## The json header lists the tokens (station ids, or [origin, dest] pairs), the stat names and
+## the number of hours. The array starts on an 8 byte boundary and is memory mapped on load, so
+## opening an archive costs one small read regardless of how many tokens it holds.
+## An hour with no statistics is stored as a row of NaN; for describe-style archives it reads
+## back as the placeholder the aggregator used when the record was computed (an hour of NULL_STATS).
+
+MAGIC = "CNDSTATS"
+SCHEMA_VERSION = 1
+N_HOURS = 24
+DESCRIBE_STATS = ['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']
+SCALAR_STATS = ['value']
+STORE_EXT = ".stats"
+LEGACY_EXT = ".dict"
+
+def _encode_token(token):
+    if isinstance(token, tuple):
+        return list(token)
+    return token
+
+def _decode_token(token):
+    if isinstance(token, list):
+        return tuple([str(t) for t in token])
+    return str(token)
+
+def _hour_row(value, stats):
+    row = np.empty(len(stats))
+    row.fill(np.nan)
+    if isinstance(value, pd.Series):
+        for i, stat in enumerate(stats):
+            if stat in value.index:
+                row[i] = value[stat]
+    elif not isinstance(value, dict):
+        row[0] = value
+    return row
+
+def write_store(fname, computedSeries, stats=DESCRIBE_STATS, n_hours=N_HOURS):
+    """Write a {token: {hour: stats}} mapping to fname in the compact format."""
+    tokens = list(computedSeries.keys())
+    data = np.empty((len(tokens), n_hours, len(stats)), dtype='<f8')
+    data.fill(np.nan)
+    for i, token in enumerate(tokens):
+        per_hour = computedSeries[token]
+        for hour in range(n_hours):
+            if hour in per_hour:
+                data[i, hour, :] = _hour_row(per_hour[hour], stats)
+    header = json.dumps({'tokens':[_encode_token(t) for t in tokens], 'stats':stats, 'hours':n_hours})
+    prefix_len = len(MAGIC) + 8 + len(header)
+    padding = (8 - prefix_len % 8) % 8
+    tmp_fname = fname + ".tmp"
+    with open(tmp_fname, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<II', SCHEMA_VERSION, len(header) + padding))
+        f.write(header + " "*padding)
+        f.write(data.tostring())
+    os.rename(tmp_fname, fname)
+    return len(tokens)
+
+class statArchive():
+    """Dict-like view of a compact stats archive, as used for aggregator.computedSeries.
+
+    Tokens are decoded from the memory mapped array on first access and cached, so repeated
+    fetches return the same object. Records assigned after loading are held in memory until
+    the aggregator writes the archive again.
+    """
+    def __init__(self, fname=None, stats=DESCRIBE_STATS, null_value=None):
+        self.fname = fname
+        self.stats = stats
+        self.null_value = null_value
+        self._index = {}
+        self._data = None
+        self._cache = {}
+        if fname is not None:
+            self._open(fname)
+
+    def _open(self, fname):
+        with open(fname, 'rb') as f:
+            magic = f.read(len(MAGIC))
+            if magic != MAGIC:
+                raise IOError(fname + " is not a stats archive")
+            version, header_len = struct.unpack('<II', f.read(8))
+            if version != SCHEMA_VERSION:
+                raise IOError(fname + " has schema version " + str(version) + "; expected " + str(SCHEMA_VERSION))
+            header = json.loads(f.read(header_len))
+        self.stats = [str(s) for s in header['stats']]
+        self.n_hours = header['hours']
+        tokens = [_decode_token(t) for t in header['tokens']]
+        self._index = dict(zip(tokens, range(len(tokens))))
+        if len(tokens) > 0:
+            self._data = np.memmap(fname, dtype='<f8', mode='r', offset=len(MAGIC) + 8 + header_len,
+                                   shape=(len(tokens), self.n_hours, len(self.stats)))
+
+    def _decode(self, token):
+        rows = self._data[self._index[token]]
+        per_hour = {}
+        for hour in range(self.n_hours):
+            row = np.array(rows[hour])
+            if np.isnan(row).all() and self.null_value is not None:
+                per_hour[hour] = self.null_value
+            elif self.stats == SCALAR_STATS:
+                per_hour[hour] = float(row[0])
+            else:
+                per_hour[hour] = pd.Series(row, index=self.stats)
+        return per_hour
+
+    def get(self, token, default=None):
+        if token in self._cache:
+            return self._cache[token]
+        if token in self._index:
+            self._cache[token] = self._decode(token)
+            return self._cache[token]
+        return default
+
+    def __getitem__(self, token):
+        value = self.get(token)
+        if value is None:
+            raise KeyError(token)
+        return value
+
+    def __setitem__(self, token, value):
+        self._cache[token] = value
+
+    def __contains__(self, token):
+        return token in self._cache or token in self._index
+
+    def keys(self):
+        return list(set(self._index.keys()) | set(self._cache.keys()))
+
+    def __len__(self):
+        return len(self.keys())
+
+def migrate_archive(legacy_fname, stats=DESCRIBE_STATS):
+    """Convert one pickled .dict archive into a .stats archive alongside it."""
+    computedSeries = pd.read_pickle(legacy_fname)
+    fname = os.path.splitext(legacy_fname)[0] + STORE_EXT
+    n = write_store(fname, computedSeries, stats)
+    print "migrated",n,"records from",legacy_fname,"to",fname
+    return fname
+
+def stats_for_archive(fname):
+    """Segment archives hold describe() Series per hour; interval and duration archives hold scalars."""
+    if "segmentAggregator" in os.path.basename(fname):
+        return DESCRIBE_STATS
+    return SCALAR_STATS
+
+def migrate_archives(data_dir="data"):
+    """One-time conversion of every pickled aggregator archive in data_dir."""
+    migrated = []
+    for legacy_fname in sorted(glob.glob(os.path.join(data_dir, ".*AggregatorArchive_*" + LEGACY_EXT))):
+        migrated.append(migrate_archive(legacy_fname, stats_for_archive(legacy_fname)))
+    return migrated
+
+if __name__ == "__main__":
+    migrate_archives()
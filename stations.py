@@ -136,8 +136,36 @@ def get_stop_dict(direction, route="LEX"):
                 return None
         return use_dict
 
+class tripDescriptor():
+    """Fields of a feed trip id such as '134750_4..S01R':
+    origin departure in hundredths of a minute past the service day reference (134750),
+    line (4), direction (S) and path (01R)."""
+    def __init__(self, trip_id):
+        self.trip_id = trip_id
+        self.line = trip_id.split("_")[1][0]
+        self.direction = trip_id.split(".")[-1][0]
+        self.key = (self.line, self.direction)
+        self.path = trip_id.split(".")[-1][1:]
+        try:
+            self.origin = float(trip_id.split("_")[0])
+        except ValueError:
+            self.origin = np.nan
+
+## every trip id is parsed once; the feed repeats each id on every poll for the life of the trip,
+## and the set of ids is bounded by the schedule since they recur from one service day to the next
+_trip_registry = {}
+
+def trip_descriptor(trip_id):
+    descriptor = _trip_registry.get(trip_id)
+    if descriptor is None:
+        if type(trip_id) == str:
+            trip_id = intern(trip_id)
+        descriptor = tripDescriptor(trip_id)
+        _trip_registry[trip_id] = descriptor
+    return descriptor
+
 def get_line(trip_id):
-    return trip_id.split("_")[1][0]
+    return trip_descriptor(trip_id).line
 
 def stop_for(l,terminus):
     return {"N":{'4':'Woodlawn', '5':'Dyre', '6':'Pelham'}, "S":{'4':'Utica', '5':'Flatbush','6':'Brooklyn Bridge'}}[terminus][l]
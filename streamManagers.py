@@ -1,76 +1,237 @@
 import pandas as pd
 import numpy as np
-from read_stream import readMTADataStream
+import Queue
+import threading
+import time
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from read_stream import readMTADataStream, feedConnection, backoff_delay
+
+FEED_COLUMNS = ['timestamp','trip_id','start_date','stop','arrive','depart']
+
+def _decode_feed_append(nyct_feed):
+    """Reference decoder: one DataFrame.append per trip (copies the frame each time)."""
+    timestamp = nyct_feed.header.timestamp
+    newDF = pd.DataFrame()
+    for entity in nyct_feed.entity:
+            if entity.trip_update.trip.trip_id:
+                    stops = [stu for stu in entity.trip_update.stop_time_update]
+                    if len(stops)>0:
+                            newDF = newDF.append([[
+                                    int(timestamp),
+                                    str(entity.trip_update.trip.trip_id),
+                                    str(entity.trip_update.trip.start_date),
+                                    str(stops[0].stop_id),
+                                    float(stops[0].arrival.time),
+                                    float(stops[0].departure.time)
+                            ]])
+    if len(newDF) > 0:
+        newDF.columns = FEED_COLUMNS
+        newDF.index = np.arange(len(newDF))
+    return newDF
+
+def decode_feed(nyct_feed):
+    """One record per trip update (its next stop) from a GTFS-realtime FeedMessage.
+
+    Walks the entities once into typed column arrays sized for the whole feed and
+    builds the DataFrame from them in one step.
+    """
+    entities = nyct_feed.entity
+    n = len(entities)
+    trip_ids = np.empty(n, dtype=object)
+    start_dates = np.empty(n, dtype=object)
+    stops = np.empty(n, dtype=object)
+    arrive = np.empty(n)
+    depart = np.empty(n)
+    count = 0
+    for entity in entities:
+        trip_update = entity.trip_update
+        trip = trip_update.trip
+        if trip.trip_id:
+            updates = trip_update.stop_time_update
+            if len(updates) > 0:
+                next_stop = updates[0]
+                trip_ids[count] = str(trip.trip_id)
+                start_dates[count] = str(trip.start_date)
+                stops[count] = str(next_stop.stop_id)
+                arrive[count] = next_stop.arrival.time
+                depart[count] = next_stop.departure.time
+                count += 1
+    timestamps = np.empty(count, dtype=np.int64)
+    timestamps.fill(int(nyct_feed.header.timestamp))
+    return pd.DataFrame(OrderedDict(zip(FEED_COLUMNS, [timestamps, trip_ids[:count], start_dates[:count],
+                                                       stops[:count], arrive[:count], depart[:count]])))
+
+FEED_DECODERS = {"append": _decode_feed_append, "columnar": decode_feed}
+
+class feedPoller():
+    """Polls several GTFS-realtime feed ids concurrently and queues merged snapshots.
+
+    Each round fetches every feed that is not backing off, on its own keep-alive connection,
+    and decodes it in a thread pool (the fetches wait on the network, and the protobuf parse
+    and decode_feed are short). A feed that fails is retried after a jittered exponential
+    backoff; meanwhile its last good snapshot stays in the merge for up to stale_after secs.
+    The queue holds (timestamp, records) with the newest feed timestamp of the round.
+    """
+    def __init__(self, feed_ids, interval=30., url=None, backoff_base=1., backoff_cap=60., stale_after=None, maxsize=10):
+        self.feed_ids = list(feed_ids)
+        self.interval = interval
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.stale_after = stale_after if stale_after is not None else 3*interval
+        self.connections = dict([(feed_id, feedConnection(feed_id, url)) for feed_id in self.feed_ids])
+        self.failures = dict([(feed_id, 0) for feed_id in self.feed_ids])
+        self.retry_at = dict([(feed_id, 0.) for feed_id in self.feed_ids])
+        self.latest = {}
+        self.queue = Queue.Queue(maxsize)
+        self.pool = ThreadPool(len(self.feed_ids))
+        self._stop = threading.Event()
+        self.thread = None
+
+    def _fetch(self, feed_id):
+        try:
+            nyct_feed = self.connections[feed_id].fetch()
+            return feed_id, nyct_feed.header.timestamp, decode_feed(nyct_feed), None
+        except Exception as e:
+            return feed_id, None, None, e
+
+    def poll(self):
+        """One round; returns the merged snapshot, or None while no feed has been read."""
+        t_round = time.time()
+        due = [feed_id for feed_id in self.feed_ids if self.retry_at[feed_id] <= t_round]
+        for feed_id, timestamp, records, error in self.pool.map(self._fetch, due):
+            if error is None:
+                self.failures[feed_id] = 0
+                self.retry_at[feed_id] = 0.
+                self.latest[feed_id] = (t_round, timestamp, records)
+            else:
+                self.failures[feed_id] += 1
+                delay = backoff_delay(self.failures[feed_id], self.backoff_base, self.backoff_cap)
+                self.retry_at[feed_id] = t_round + delay
+                print "feedPoller: feed",feed_id,"failed",self.failures[feed_id],"times (",error,"); retrying in","%.1f" % delay,"secs"
+        current = [self.latest[feed_id] for feed_id in self.feed_ids
+                   if feed_id in self.latest and t_round - self.latest[feed_id][0] <= self.stale_after]
+        if len(current) == 0:
+            return None
+        timestamp = max([timestamp for t_read, timestamp, records in current])
+        return timestamp, pd.concat([records for t_read, timestamp, records in current], ignore_index=True)
+
+    def _run(self):
+        while not self._stop.is_set():
+            t0 = time.time()
+            snapshot = self.poll()
+            if snapshot is not None:
+                try:
+                    self.queue.put_nowait(snapshot)
+                except Queue.Full:
+                    # the reader has fallen behind; drop the oldest snapshot rather than block polling
+                    try:
+                        self.queue.get_nowait()
+                    except Queue.Empty:
+                        pass
+                    self.queue.put_nowait(snapshot)
+            self._stop.wait(max(0., self.interval - (time.time() - t0)))
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="feedPoller")
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.pool.close()
+        self.pool.join()
+        for connection in self.connections.values():
+            connection.close()
+
+    def newest(self, timeout=None):
+        """Block for a snapshot, then skip to the most recent one queued."""
+        snapshot = self.queue.get(timeout=timeout)
+        while True:
+            try:
+                snapshot = self.queue.get_nowait()
+            except Queue.Empty:
+                return snapshot
 
 class streamManager():
     def __init__(self):
-        pass
+        self.acceleration = 1.
+        self._stop = threading.Event()
 
     def read(self):
         print "streamManager.read() must be implemented by derived class!",self
 
+    def stop(self):
+        ## ask a read that is waiting on the feed to give up
+        self._stop.set()
+
 class liveStreamReader(streamManager):
-    def __init__(self):
+    def __init__(self, feed_ids=None, interval=30., url=None):
         streamManager.__init__(self)
         self.T0 = None
+        self.interval = interval
+        ## with feed_ids, a feedPoller reads those feeds in the background and read() takes its newest snapshot
+        self.poller = None
+        if feed_ids is not None:
+            self.poller = feedPoller(feed_ids, interval, url).start()
 
     def read(self, t1, t2):
+        """Wait for the next feed snapshot; after stop() returns an empty frame stamped t1."""
+        if self.poller is not None:
+            while not self._stop.is_set():
+                try:
+                    self.T0, newDF = self.poller.newest(timeout=self.interval)
+                except Queue.Empty:
+                    continue
+                print "liveStreamReader ==> Read", len(newDF), "records from feeds",self.poller.feed_ids
+                return self.T0, newDF
+            return t1, pd.DataFrame(columns=FEED_COLUMNS)
         nyct_feed = None
         attempts = 0
         while not nyct_feed:
+            if self._stop.is_set():
+                return t1, pd.DataFrame(columns=FEED_COLUMNS)
             attempts += 1
             nyct_feed = readMTADataStream()
-        timestamp = nyct_feed.header.timestamp
-        self.T0 = timestamp
-        count = 0
-        newDF = pd.DataFrame()
-        for entity in nyct_feed.entity:
-                if entity.trip_update.trip.trip_id:
-                        stops = [stu for stu in entity.trip_update.stop_time_update]
-                        if len(stops)>0:
-                                count += 1
-                                newDF = newDF.append([[
-                                        int(timestamp),
-                                        str(entity.trip_update.trip.trip_id),
-                                        str(entity.trip_update.trip.start_date),
-                                        str(stops[0].stop_id),
-                                        float(stops[0].arrival.time),
-                                        float(stops[0].departure.time)
-                                ]])
+            if not nyct_feed:
+                self._stop.wait(backoff_delay(attempts))
+        self.T0 = nyct_feed.header.timestamp
+        newDF = decode_feed(nyct_feed)
         print "liveStreamReader ==> Read", len(newDF), "records after",attempts,"attempts."
         if len(newDF) == 0:
             print "returning length ZERO dataframe from stream read"
-        else:
-            newDF.columns = ['timestamp','trip_id','start_date','stop','arrive','depart']
-            newDF.index = np.arange(len(newDF))
         return self.T0, newDF
 
+    def stop(self):
+        streamManager.stop(self)
+        if self.poller is not None:
+            self.poller.stop()
+
 class streamSimulator(streamManager):
-    def __init__(self, fname):
+    def __init__(self, fname, acceleration=1.):
         streamManager.__init__(self)
         self.df = pd.read_csv(fname)
+        ## replay speed relative to the recorded stream, picked up by plotManager
+        self.acceleration = acceleration
         self.initDF()
-        ## expect timestamps in this df to be ordered (but this is not checked)
 
     def initDF(self):
-        times = self.df['timestamp'].unique()
-        self.T0 = self.df['timestamp'].min()
-        self.Tfinal = self.df['timestamp'].max()
+        ## sort once so every read window is a contiguous slice found by binary search
+        self.df = self.df.sort_values('timestamp', kind='mergesort')
+        self.df.index = np.arange(len(self.df))
+        self.times = self.df['timestamp'].values
+        self.T0 = self.times[0]
+        self.Tfinal = self.times[-1]
         print "Datafame contains range of timestamps",self.T0,self.Tfinal
         self.index_position = 0
-	self.index_max = len(self.df) - 1
+        self.index_max = len(self.df)
 
     def read(self, t1, t2):
-	index_range = []
-        t__ = self.df.loc[self.index_position, 'timestamp']
-        while t__ < t1:
-            self.index_position = self.index_position + 1
-            t__ = self.df.loc[self.index_position, 'timestamp']
-
-        while t__ <= t2 and self.index_position<self.index_max:
-	    index_range.append(self.index_position)
-            self.index_position = self.index_position + 1
-            t__ = self.df.loc[self.index_position, 'timestamp']
-	#print "    collect range",index_range
-
-        return t1, self.df.loc[index_range,:]
+        """Records stamped in [t1, t2] not returned by an earlier read, as a slice of the stored frame."""
+        start = max(self.index_position, np.searchsorted(self.times, t1, side='left'))
+        stop = max(start, np.searchsorted(self.times, t2, side='right'))
+        self.index_position = stop
+        return t1, self.df.iloc[start:stop]
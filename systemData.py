@@ -1,5 +1,7 @@
 import pandas as pd
 
+import stations
+
 class stationLoc():
         data = pd.read_csv("stops_formatted.txt", index_col=0)
 
@@ -478,11 +480,40 @@ class routeData():
         data.columns = ['line','direction','id','origin','destination','travel_time']
         data['index_col'] = data['origin'] + "_" + data['destination']
 	data = data.set_index('index_col')
+        _adjacency = None
 
         def get(self, line, direction):
                 sliceDF = self.data[self.data['line'] == line]
                 sliceDF = sliceDF[sliceDF['direction'] == direction]
                 return sliceDF
 
+        def adjacency(self):
+                """Neighbouring stops along each line, built once and shared by every routeData.
+
+                Returns ({(line, direction, stop): [predecessor, successor]}, {stop: predecessor}).
+                The first map comes from this table's segments, filled in from the stations.code_order
+                lists; the second is keyed by stop alone, for trips on a line the table does not cover,
+                and keeps the first segment listed for a stop as the old full-table scan did.
+                """
+                if routeData._adjacency is None:
+                        neighbours = {}
+                        any_line = {}
+                        for ll, dd, origin, dest in zip(self.data['line'], self.data['direction'], self.data['origin'], self.data['destination']):
+                                neighbours.setdefault((ll, dd, dest), [None, None])[0] = origin
+                                neighbours.setdefault((ll, dd, origin), [None, None])[1] = dest
+                                any_line.setdefault(dest, origin)
+                        for ll in stations.lines:
+                                for dd in stations.directions:
+                                        code_order = getattr(stations, "code_order_" + ll + "_" + dd, [])
+                                        for origin, dest in zip(code_order[:-1], code_order[1:]):
+                                                pair = neighbours.setdefault((ll, dd, dest), [None, None])
+                                                if pair[0] is None:
+                                                        pair[0] = origin
+                                                pair = neighbours.setdefault((ll, dd, origin), [None, None])
+                                                if pair[1] is None:
+                                                        pair[1] = dest
+                        routeData._adjacency = (neighbours, any_line)
+                return routeData._adjacency
+
 	def __getitem__(self, (ind, col)):
 		return self.data.loc[ind, col]
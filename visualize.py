@@ -6,6 +6,7 @@ import bokeh.embed
 import bokeh.resources
 from collect import *
 from stations import *
+from columnStore import read_stop_table
 import os
 
 file_timestamp = "1404840164"
@@ -116,9 +117,9 @@ def prepareScheduleDatetime(set_line, set_direction, code_order, station_map, T0
 
 def plotTimeEvolution(db_index, set_line, set_direction, show_plot=True):
 	file_root = db.loc[db_index,'file'].values[0]
-	D_stoptimes = pd.read_csv(file_root+"_stoptimes.csv",index_col=0)
 	station_order, code_order, station_map, station_index = \
 		get_station_map(set_direction, set_line)
+	D_stoptimes = read_stop_table(file_root+"_stoptimes", stations=code_order)
 	useColor = "#0066CC"
 	output_file("plot_time_evol_"+set_line+"_"+set_direction+".html")
 
@@ -154,9 +155,9 @@ def plot_trip_trajectories(for_lines=['4','5','6'], for_directions=['N','S']):
 			print "referred to db index",db_index
 			file_root = db.loc[db_index,'file'].values[0]
 			print file_root
-			df_stoptimes = pd.read_csv(file_root+"_stoptimes.csv",index_col=0)
-			df_howlate = pd.read_csv(file_root+"_howlate.csv",index_col=0)
 			station_order, code_order, station_map, station_index = get_station_map(d, set_line)
+			df_stoptimes = read_stop_table(file_root+"_stoptimes", stations=code_order)
+			df_howlate = read_stop_table(file_root+"_howlate", stations=code_order)
 			first_stop = code_order[0]
 			last_stop = code_order[-1]
 			df_triptimes = pd.DataFrame(index=df_stoptimes.index, columns=['trip_time'])
@@ -224,8 +225,8 @@ def plot_departure_delays(for_lines=['4','5','6'], for_directions=['N','S']):
 			file_root = db.loc[db_index,'file'].values[0]
 			print file_root
 			#df_stoptimes = pd.read_csv(file_root+"_stoptimes.csv",index_col=0)
-			df_howlate = pd.read_csv(file_root+"_howlate.csv",index_col=0)
 			station_order, code_order, station_map, station_index = get_station_map(d, l)
+			df_howlate = read_stop_table(file_root+"_howlate", stations=code_order[1:-1])
 			useColor = "#0066CC"
 			output_file("plot_delays_"+l+"_"+d+".html")
 			figure(x_range=station_order)
@@ -292,9 +293,8 @@ def plot_time_evolution(for_lines=['4','5','6'], for_directions=['N','S']):
 			print "referred to db index",db_index
 			file_root = db.loc[db_index,'file'].values[0]
 			print file_root
-			D_stoptimes = pd.read_csv(file_root+"_stoptimes.csv",index_col=0)
-			#df_howlate = pd.read_csv(file_root+"_howlate.csv",index_col=0)
 			station_order, code_order, station_map, station_index = get_station_map(set_dir, set_line)
+			D_stoptimes = read_stop_table(file_root+"_stoptimes", stations=code_order)
 			useColor = "#0066CC"
 			output_file("plot_time_evol_"+set_line+"_"+set_dir+".html")
 
@@ -392,8 +392,8 @@ def plot_trip_intervals(for_lines=['4','5','6'], for_directions=['N','S']):
 			file_root = db.loc[db_index,'file'].values[0]
 			print file_root
 			#D_stoptimes = pd.read_csv(file_root+"_stoptimes.csv",index_col=0)
-			D_howlate = pd.read_csv(file_root+"_howlate.csv",index_col=0)
 			station_order, code_order, station_map, station_index = get_station_map(d, set_line)
+			D_howlate = read_stop_table(file_root+"_howlate", stations=code_order)
 			useColor = "#0066CC"
 			output_file("plot_trip_intervals_"+set_line+"_"+d+".html")
 
@@ -513,9 +513,8 @@ def plot_time_evolution_numeric(for_lines=['4','5','6'], for_directions=['N','S'
 			print "referred to db index",db_index
 			file_root = db.loc[db_index,'file'].values[0]
 			print file_root
-			D_stoptimes = pd.read_csv(file_root+"_stoptimes.csv",index_col=0)
-			#df_howlate = pd.read_csv(file_root+"_howlate.csv",index_col=0)
 			station_order, code_order, station_map, station_index = get_station_map(d, l)
+			D_stoptimes = read_stop_table(file_root+"_stoptimes", stations=code_order)
 			useColor = "#0066CC"
 			output_file("plot_time_evol_"+l+"_"+d+".html")
 